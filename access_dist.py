@@ -0,0 +1,70 @@
+# access_dist.py - skewed file access distributions (zipf and hot-set/cold-set)
+#
+# both generate blocks of file indices for a random_pool.  the zipf
+# distribution uses the method of Gray et al, "Quickly Generating
+# Billion-Record Synthetic Databases" (SIGMOD 1994), as YCSB does: after
+# computing a few constants once, each sample is O(1), so no per-file table
+# is needed even for hundreds of millions of files.
+
+import numpy
+import opts
+
+# constants for the zipf distribution, computed by init_zipf()
+
+zipf_params = None
+
+# zeta(n, theta) = sum of 1/i^theta for i in 1..n, summed in chunks so that
+# memory use doesn't depend on n
+
+zeta_chunk = 1 << 22
+
+
+def zeta(n, theta):
+    total = 0.0
+    for first in range(1, n + 1, zeta_chunk):
+        i = numpy.arange(first, min(first + zeta_chunk, n + 1), dtype=numpy.float64)
+        total += numpy.sum(numpy.power(i, -theta))
+    return total
+
+
+def init_zipf(n, theta):
+    global zipf_params
+    zetan = zeta(n, theta)
+    zeta2 = zeta(2, theta)
+    alpha = 1.0 / (1.0 - theta)
+    eta = (1.0 - pow(2.0 / n, 1.0 - theta)) / (1.0 - (zeta2 / zetan))
+    zipf_params = (n, theta, zetan, alpha, eta)
+
+# returns zipf ranks, 0 is the most popular
+
+
+def gen_zipf_block(count):
+    (n, theta, zetan, alpha, eta) = zipf_params
+    u = numpy.random.random_sample(count)
+    uz = u * zetan
+    ranks = numpy.floor(n * numpy.power((eta * u) - eta + 1.0, alpha)).astype(numpy.int64)
+    ranks[uz < 1.0 + pow(0.5, theta)] = 1
+    ranks[uz < 1.0] = 0
+    return numpy.minimum(ranks, n - 1)
+
+# hot_ops_pct percent of accesses go to the first hot_set_pct percent of files,
+# the rest go to the other files, uniformly within each set
+
+
+def gen_hotspot_block(count):
+    n = opts.max_files
+    hot_n = max(1, int(n * opts.hot_set_pct / 100.0))
+    cold_n = max(1, n - hot_n)
+    pick = numpy.random.random_sample(count)
+    hot = numpy.random.random_sample(count) < (opts.hot_ops_pct / 100.0)
+    indices = numpy.where(hot, pick * hot_n, hot_n + (pick * cold_n)).astype(numpy.int64)
+    return numpy.minimum(indices, n - 1)
+
+
+if __name__ == '__main__':
+    n = 1000000
+    init_zipf(n, 0.99)
+    ranks = gen_zipf_block(1000000)
+    top = numpy.bincount(ranks, minlength=n)
+    for k in (1, 10, 100, 1000, 10000):
+        print('top %6d files get %5.1f%% of accesses' % (k, 100.0 * numpy.sum(top[0:k]) / len(ranks)))
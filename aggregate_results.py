@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+# aggregate_results.py - combine response time and bandwidth files from any
+# number of fs-drift workers and hosts into statistics per time interval
+#
+# usage:
+#   python aggregate_results.py [ --lag seconds ] interval-seconds csv-file ...
+# where each csv-file is a /var/tmp/fs-drift_*_rspt.csv file (--response-times)
+# or a /var/tmp/fs-drift_*_bw.csv file (--bandwidth).  it writes CSV to
+# stdout with one row per interval, file type and operation type:  the
+# operation count and rate, and the mean and percentiles of response time
+# in milliseconds, or of bandwidth in KB/s.
+#
+# the files are read in chunks, always from the file that is furthest behind,
+# and each interval is written out and forgotten once every file has moved
+# a whole interval past its end, plus a lag.  lines are written when an
+# operation finishes but carry the time it started (or was scheduled to
+# start, with --target-rate), so a slow operation's line comes after lines
+# of operations that started later.  the lag is the largest response time
+# seen so far, or the --lag given if that is larger, so slow operations
+# aren't dropped for arriving after their interval was written.  samples
+# are counted into log-bucketed histograms (see histogram.py) with numpy,
+# so memory use depends on the number of files and operation types, not on
+# the size of the files.
+# times are seconds since each fs-drift run started, so runs on many hosts
+# line up if they were started together (see coordinator.py).
+
+import sys
+import numpy
+from common import NOTOK
+from histogram import latency_histogram, bucket_indices, bucket_count, hist_len, \
+    MAX_INDEX, report_percentiles
+
+# bytes of lines read from a file at a time
+
+chunk_bytes = 1 << 22
+
+RSPTIME = 'rspt'
+BANDWIDTH = 'bw'
+
+# response times are recorded in microseconds, bandwidth in KB/s
+
+units_per_value = {RSPTIME: 1000000.0, BANDWIDTH: 1.0}
+
+# reported response times are in milliseconds
+
+report_scale = {RSPTIME: 1000.0, BANDWIDTH: 1.0}
+
+
+def file_kind(filename):
+    if filename.endswith('_rspt.csv'):
+        return RSPTIME
+    if filename.endswith('_bw.csv'):
+        return BANDWIDTH
+    usage('%s is not a response time (_rspt.csv) or bandwidth (_bw.csv) file' % filename)
+
+
+class result_file:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.kind = file_kind(filename)
+        self.f = open(filename, 'r')
+        self.last_time = -1.0
+
+    # return arrays of start times, values and operation names for the next
+    # chunk of lines, or None at end of file
+
+    def next_chunk(self):
+        lines = self.f.readlines(chunk_bytes)
+        if not lines:
+            self.f.close()
+            return None
+        fields = [l.split(',') for l in lines]
+        fields = [f for f in fields if len(f) == 3]
+        if not fields:
+            return self.next_chunk()
+        times = numpy.array([f[0] for f in fields], dtype=numpy.float64)
+        values = numpy.array([f[1] for f in fields], dtype=numpy.float64)
+        names = [f[2].strip() for f in fields]
+        self.last_time = max(self.last_time, times.max())
+        return (times, values, names)
+
+# histograms of the samples in one interval, one per (file kind, operation)
+
+
+class interval_stats:
+
+    def __init__(self):
+        self.histograms = {}
+        self.sums = {}
+
+    def add(self, kind, name, values):
+        key = (kind, name)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = numpy.zeros(hist_len)
+            self.histograms[key] = hist
+        scaled = values * units_per_value[kind]
+        hist[0:bucket_count] += numpy.bincount(bucket_indices(scaled), minlength=bucket_count)
+        hist[MAX_INDEX] = max(hist[MAX_INDEX], scaled.max())
+        self.sums[key] = self.sums.get(key, 0.0) + values.sum()
+
+
+class aggregator:
+
+    def __init__(self, interval, lag=0.0):
+        self.interval = interval
+        self.lag = lag
+        self.max_latency = 0.0
+        self.intervals = {}
+        self.next_flush = 0  # intervals below this one have been written
+        self.late_samples = 0
+
+    def add(self, kind, times, values, names):
+        if kind == RSPTIME:
+            self.max_latency = max(self.max_latency, values.max())
+        slots = numpy.floor(times / self.interval).astype(numpy.int64)
+        late = slots < self.next_flush
+        if late.any():
+            self.late_samples += int(late.sum())
+        names = numpy.array(names)
+        for slot in numpy.unique(slots[~late]):
+            in_slot = slots == slot
+            stats = self.intervals.get(int(slot))
+            if stats is None:
+                stats = interval_stats()
+                self.intervals[int(slot)] = stats
+            slot_names = names[in_slot]
+            slot_values = values[in_slot]
+            for name in numpy.unique(slot_names):
+                stats.add(kind, str(name), slot_values[slot_names == name])
+
+    # write out every interval that ends at least one interval and the lag
+    # before the given time
+
+    def flush(self, watermark):
+        holdback = max(self.lag, self.max_latency)
+        while self.intervals:
+            slot = min(self.intervals.keys())
+            if (slot + 2) * self.interval + holdback > watermark:
+                break
+            self.write_interval(slot, self.intervals.pop(slot))
+            self.next_flush = slot + 1
+
+    def write_interval(self, slot, stats):
+        start = slot * self.interval
+        for key in sorted(stats.histograms.keys()):
+            (kind, name) = key
+            h = latency_histogram(stats.histograms[key].tolist())
+            count = h.count()
+            scale = report_scale[kind] / units_per_value[kind]
+            pcts = [h.percentile(p) * 1000000.0 * scale for p in report_percentiles]
+            row = [start, start + self.interval, kind, name, count, count / self.interval,
+                   stats.sums[key] * report_scale[kind] / count] + pcts + \
+                  [h.max() * 1000000.0 * scale]
+            print(','.join(['%.3f' % v if isinstance(v, float) else str(v) for v in row]))
+
+
+def aggregate(interval, filenames, lag=0.0):
+    print(','.join(['start', 'end', 'file_type', 'op', 'count', 'ops_per_sec', 'mean'] +
+                   ['p%g' % p for p in report_percentiles] + ['max']))
+    agg = aggregator(interval, lag)
+    active = [result_file(fn) for fn in filenames]
+    while active:
+        r = min(active, key=lambda r: r.last_time)
+        chunk = r.next_chunk()
+        if chunk is None:
+            active.remove(r)
+        else:
+            agg.add(r.kind, *chunk)
+        if active:
+            agg.flush(min([r.last_time for r in active]))
+    agg.flush(float('inf'))
+    sys.stdout.flush()
+    if agg.late_samples > 0:
+        sys.stderr.write('%d samples arrived after their interval was written and were skipped, '
+                         'try a larger --lag\n' % agg.late_samples)
+
+
+def usage(msg):
+    print(msg)
+    print('usage: aggregate_results.py [ --lag seconds ] interval-seconds csv-file ...')
+    sys.exit(NOTOK)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    lag = 0.0
+    if args and args[0] == '--lag':
+        if len(args) < 2:
+            usage('--lag needs a value')
+        try:
+            lag = float(args[1])
+        except ValueError as e:
+            usage(str(e))
+        if lag < 0:
+            usage('lag must not be negative')
+        args = args[2:]
+    if len(args) < 2:
+        usage('too few parameters')
+    try:
+        interval = float(args[0])
+    except ValueError as e:
+        usage(str(e))
+    if interval <= 0:
+        usage('interval must be greater than 0')
+    aggregate(interval, args[1:], lag)
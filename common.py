@@ -20,11 +20,26 @@ class rq:
     RENAME = 7
     TRUNCATE = 8
     HARDLINK = 9
+    COPY = 10
+    CLONE = 11
+    STAT = 12
+    LSTAT = 13
+    READDIR = 14
+    GETXATTR = 15
+    SETXATTR = 16
+    CHMOD = 17
+    UTIME = 18
+    PREALLOCATE = 19
+    PUNCH_HOLE = 20
+    ZERO_RANGE = 21
 
 
 class file_access_dist:
     UNIFORM = 2
     GAUSSIAN = 3
+    ZIPF = 4
+    HOTSPOT = 5
+    LATEST = 6
 
 global fsdrift_directory
 fsdrift_directory = os.path.dirname(__file__)
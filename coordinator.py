@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+
+# coordinator.py - start fs-drift.py processes on many hosts at the same time
+# and collect their counters while they run
+#
+# on one host run:
+#   python coordinator.py port agent-count [ report-file ]
+# and on every client run fs-drift.py with "--controller controller-host:port".
+# the controller waits until agent-count agents have connected, tells them all
+# to start at once, prints counters summed across agents as they arrive, and
+# when every agent is done writes a merged report in JSON format.
+#
+# controller and agents exchange one JSON object per line over TCP, so nothing
+# has to be polled on the filesystem under test.
+
+import os
+import sys
+import time
+import json
+import socket
+import threading
+from common import NOTOK, BYTES_PER_MB
+from histogram import latency_histogram, print_latency_table
+from stats import counter_snapshot, summed_rates
+
+# seconds an agent keeps trying to reach a controller that isn't listening yet
+connect_timeout = 60
+
+# seconds between agent counter reports, and between controller summaries
+agent_report_interval = 1.0
+controller_report_interval = 5.0
+
+default_report_filename = 'fs-drift-report.json'
+
+
+def send_msg(sock, msg):
+    sock.sendall((json.dumps(msg) + '\n').encode())
+
+
+def recv_msg(reader):
+    line = reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+# add up the counter dictionaries sent by agents, as a counter_snapshot.
+# agents that haven't reported yet have no counters
+
+
+def merge_counters(counter_dicts):
+    snapshots = [counter_snapshot.from_dict(c) for c in counter_dicts if c]
+    if not snapshots:
+        return None
+    return counter_snapshot.merge(snapshots)
+
+# the fs-drift.py side of the connection
+
+
+class agent_connection:
+
+    def __init__(self, host_port):
+        (host, port) = host_port.rsplit(':', 1)
+        deadline = time.time() + connect_timeout
+        while True:
+            try:
+                self.sock = socket.create_connection((host, int(port)))
+                break
+            except socket.error as e:
+                if time.time() > deadline:
+                    raise e
+                time.sleep(0.5)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('r')
+
+    def hello(self, workers):
+        send_msg(self.sock, {'type': 'hello', 'host': socket.gethostname(),
+                             'pid': os.getpid(), 'workers': workers})
+
+    # block until the controller says every agent is ready
+
+    def wait_for_start(self):
+        msg = recv_msg(self.reader)
+        if msg is None or msg['type'] != 'start':
+            raise Exception('controller did not send start message: %s' % str(msg))
+
+    def send_counters(self, elapsed, counters):
+        send_msg(self.sock, {'type': 'counters', 'elapsed': elapsed, 'counters': counters})
+
+    # histograms is a list of (operation name, latency_histogram)
+
+    def send_done(self, elapsed, counters, histograms):
+        send_msg(self.sock, {'type': 'done', 'elapsed': elapsed, 'counters': counters,
+                             'histograms': [(name, list(h.values)) for (name, h) in histograms]})
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+# the controller's record of one agent, updated by a thread reading its messages
+
+
+class agent_record:
+
+    def __init__(self, sock, hello):
+        self.sock = sock
+        self.host = hello['host']
+        self.pid = hello['pid']
+        self.workers = hello['workers']
+        self.elapsed = 0.0
+        self.counters = {}
+        self.last_counters = None  # as of the last report interval
+        self.last_elapsed = 0.0
+        self.histograms = []
+        self.done = False
+
+    def name(self):
+        return '%s:%d' % (self.host, self.pid)
+
+
+def read_agent_messages(agent, reader, lock):
+    while True:
+        msg = recv_msg(reader)
+        with lock:
+            if msg is None:
+                if not agent.done:
+                    print('lost connection to agent %s' % agent.name())
+                agent.done = True
+                return
+            agent.elapsed = msg['elapsed']
+            agent.counters = msg['counters']
+            if msg['type'] == 'done':
+                agent.histograms = msg['histograms']
+                agent.done = True
+                return
+
+
+# rates for the interval since the last report, each agent's counts over the
+# time between its own reports.  an agent's elapsed time is when its
+# workers last published the counters it sent
+
+
+def agent_rates(agents):
+    deltas = []
+    for a in agents:
+        if not a.counters:
+            continue
+        s = counter_snapshot.from_dict(a.counters)
+        last = a.last_counters
+        if last is None or last.names != s.names:
+            last = counter_snapshot(s.names)
+        deltas.append((s.delta(last), a.elapsed - a.last_elapsed))
+        a.last_counters = s
+        a.last_elapsed = a.elapsed
+    return summed_rates(deltas)
+
+# print cumulative counters, and rates for the interval since the last report
+
+
+def print_interval(elapsed, c, r, running):
+    print('%9.1f %7d %12u %10u %10u %10.1f %10.1f %7u %10.1f %9.1f %9.1f' % (
+        elapsed, running, c.get('events'), c.get('have_created'),
+        c.get('have_read'), c.get('read_bytes') / float(BYTES_PER_MB),
+        c.get('write_bytes') / float(BYTES_PER_MB), c.get('total_errors'),
+        r['ops'], r['read_mb'], r['write_mb']))
+    sys.stdout.flush()
+
+
+def run_controller(port, agent_count, report_filename):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', port))
+    listener.listen(agent_count)
+    print('waiting for %d agents on port %d' % (agent_count, port))
+    sys.stdout.flush()
+
+    agents = []
+    readers = []
+    while len(agents) < agent_count:
+        (sock, addr) = listener.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = sock.makefile('r')
+        hello = recv_msg(reader)
+        if hello is None or hello['type'] != 'hello':
+            print('ignoring connection from %s' % str(addr))
+            sock.close()
+            continue
+        a = agent_record(sock, hello)
+        print('agent %s connected with %d workers' % (a.name(), a.workers))
+        agents.append(a)
+        readers.append(reader)
+    listener.close()
+
+    # everyone is connected, so fire the starting gun on all of them at once
+
+    start_time = time.time()
+    for a in agents:
+        send_msg(a.sock, {'type': 'start', 'time': start_time})
+    print('started %d agents' % len(agents))
+
+    lock = threading.Lock()
+    threads = [threading.Thread(target=read_agent_messages, args=(a, r, lock))
+               for (a, r) in zip(agents, readers)]
+    for t in threads:
+        t.start()
+
+    print('%9s %7s %12s %10s %10s %10s %10s %7s %10s %9s %9s' % (
+        'elapsed', 'running', 'ops', 'created', 'read', 'read-MB', 'write-MB', 'errors',
+        'ops/s', 'rd-MB/s', 'wr-MB/s'))
+    intervals = []
+    while True:
+        deadline = time.time() + controller_report_interval
+        for t in threads:
+            t.join(max(0.0, deadline - time.time()))
+        with lock:
+            running = len([a for a in agents if not a.done])
+            total = merge_counters([a.counters for a in agents])
+            rates = agent_rates(agents)
+        elapsed = time.time() - start_time
+        if total is None:
+            total = counter_snapshot(['events'])
+        intervals.append({'elapsed': elapsed, 'counters': total.as_dict(), 'rates': rates})
+        print_interval(elapsed, total, rates, running)
+        if running == 0:
+            break
+
+    histograms = {}
+    for a in agents:
+        for (name, values) in a.histograms:
+            h = histograms.setdefault(name, latency_histogram())
+            h.merge(latency_histogram(values))
+    merged_histograms = sorted(histograms.items())
+    print()
+    print_latency_table(merged_histograms)
+
+    report = {
+        'start_time': start_time,
+        'agents': [{'host': a.host, 'pid': a.pid, 'workers': a.workers,
+                    'elapsed': a.elapsed, 'counters': a.counters} for a in agents],
+        'intervals': intervals,
+        'total': total.as_dict(),
+        'rates': summed_rates([(counter_snapshot.from_dict(a.counters), a.elapsed)
+                               for a in agents if a.counters]),
+        'latency_percentiles': dict([(name, {
+            'count': h.count(),
+            'p50': h.percentile(50.0), 'p90': h.percentile(90.0),
+            'p99': h.percentile(99.0), 'p99.9': h.percentile(99.9),
+            'max': h.max()}) for (name, h) in merged_histograms if h.count() > 0])}
+    with open(report_filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    print('merged report is %s' % report_filename)
+
+
+def usage(msg):
+    print(msg)
+    print('usage: coordinator.py port agent-count [ report-file ]')
+    sys.exit(NOTOK)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or len(sys.argv) > 4:
+        usage('wrong number of parameters')
+    try:
+        port = int(sys.argv[1])
+        agent_count = int(sys.argv[2])
+    except ValueError as e:
+        usage(str(e))
+    report_filename = default_report_filename
+    if len(sys.argv) == 4:
+        report_filename = sys.argv[3]
+    run_controller(port, agent_count, report_filename)
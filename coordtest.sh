@@ -0,0 +1,51 @@
+#!/bin/bash
+# coordtest.sh - run a controller and two agents on this host and check
+# the merged report.  optional parameter 1 is the controller port
+OK=0  # process successful exit status
+NOTOK=1 # process failure exit status
+
+port=${1:-17001}
+timestamp=`date +%Y-%m-%d-%H-%M`
+logdir=/var/tmp/fs-drift-coordtest-$timestamp
+report=$logdir/report.json
+
+rm -rf $logdir
+mkdir -pv $logdir/agent1 $logdir/agent2
+
+chk()
+{
+  echo "$1"
+  eval "$1"
+  if [ $? != $OK ] ; then echo ERROR ; exit $NOTOK ; fi
+}
+
+chk "python3 statstest.py > $logdir/statstest.log 2>&1"
+
+python3 coordinator.py $port 2 $report > $logdir/controller.log 2>&1 &
+controller=$!
+for a in 1 2 ; do
+  python3 fs-drift.py -t $logdir/agent$a -d 5 -f 100 -+C localhost:$port > $logdir/agent$a.log 2>&1 &
+  eval agent$a=$!
+done
+for p in $agent1 $agent2 $controller ; do
+  wait $p
+  if [ $? != $OK ] ; then echo "ERROR: process $p failed, see logs in $logdir" ; exit $NOTOK ; fi
+done
+
+chk "python3 - $report <<EOF
+import sys, json
+report = json.load(open(sys.argv[1]))
+agents = report['agents']
+assert len(agents) == 2, 'expected 2 agents, got %d' % len(agents)
+assert agents[0]['pid'] != agents[1]['pid']
+for a in agents:
+    assert a['elapsed'] > 0 and a['counters']['events'] > 0
+events = sum([a['counters']['events'] for a in agents])
+assert report['total']['events'] == events, 'total events %s != %s' % (report['total']['events'], events)
+assert report['rates']['ops'] > 0
+assert len(report['intervals']) > 0
+assert len(report['latency_percentiles']) > 0
+for p in report['latency_percentiles'].values():
+    assert p['count'] > 0 and p['p50'] <= p['p99'] <= p['max']
+EOF"
+echo "coordinator test passed, logs in $logdir"
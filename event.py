@@ -2,12 +2,13 @@
 # and also parses the workload specification which controls frequency of different event types
 
 import sys
-import random
+import numpy
 # from fs-drift modules
 import common
 from common import rq
 import fsop
 import opts
+from random_pool import random_pool
 
 # normalize weights and compute table that maps random # into rq type
 # FIXME: read weights in from user
@@ -15,10 +16,24 @@ import opts
 # default weights are:
 
 weights = {rq.READ: 10, rq.RANDOM_READ: 2, rq.CREATE: 4, rq.RANDOM_WRITE: 2,
-           rq.APPEND: 2, rq.LINK: 0, rq.DELETE: 1, rq.RENAME: 0, rq.TRUNCATE: 1, rq.HARDLINK: 2}
+           rq.APPEND: 2, rq.LINK: 0, rq.DELETE: 1, rq.RENAME: 0, rq.TRUNCATE: 1, rq.HARDLINK: 2,
+           rq.COPY: 0, rq.CLONE: 0, rq.STAT: 0, rq.LSTAT: 0, rq.READDIR: 0,
+           rq.GETXATTR: 0, rq.SETXATTR: 0, rq.CHMOD: 0, rq.UTIME: 0,
+           rq.PREALLOCATE: 0, rq.PUNCH_HOLE: 0, rq.ZERO_RANGE: 0}
 
 normalized_weights = {}
 
+# opcodes and their cumulative probabilities as arrays, so a whole block of
+# events can be generated with one searchsorted() call.  both are replaced
+# together as one tuple when the workload table is re-read.
+
+event_table = (None, None)
+
+# incremented whenever the weights change, so that every thread discards
+# events it already generated from the old weights
+
+weights_generation = 0
+
 
 def parse_weights():
     global weights
@@ -46,7 +61,7 @@ def parse_weights():
 
 
 def normalize_weights():
-    global normalized_weights
+    global normalized_weights, event_table, weights_generation
     total_weight = 0.0
     for (opcode, weight) in list(weights.items()):
         total_weight += weight
@@ -64,23 +79,36 @@ def normalize_weights():
         print('%20s  %9u   %5.3f      %5.3f' %\
             (name, weight, cum_probability, probability))
     print()
+    opcodes = numpy.array(list(normalized_weights.keys()))
+    cum_probabilities = numpy.array(list(normalized_weights.values()))
+    # guard against rounding leaving the last probability just below 1.0
+    cum_probabilities[-1] = 1.0
+    event_table = (opcodes, cum_probabilities)
+    weights_generation += 1
+
+
+def gen_event_block(n):
+    (opcodes, cum_probabilities) = event_table
+    r = numpy.random.random_sample(n)
+    return opcodes[numpy.searchsorted(cum_probabilities, r, side='right')]
+
+
+event_pool = random_pool(gen_event_block, traced=False)
 
 
 def gen_event():
-    r = random.uniform(0.0, 1.0)
+    if event_pool.generation != weights_generation:
+        event_pool.reset()
+        event_pool.generation = weights_generation
+    opcode = event_pool.next()
     if common.verbosity & 0x200000:
-        print('random event generator = %f' % r)
-    for (opcode, cumulative_probability) in list(normalized_weights.items()):
-        (fn, opname) = fsop.rq_map[opcode]
-        if common.verbosity & 0x100:
-            print(opcode, opname, cumulative_probability)
-        if r < cumulative_probability:
-            return opcode
+        print('random event = %d' % opcode)
     return opcode
 
 
 if __name__ == '__main__':
-    histogram = list(range(0, len(weights)))
+    normalize_weights()
+    histogram = [0 for opcode in range(0, len(fsop.rq_map))]
     for i in range(0, 1000):
         histogram[gen_event()] += 1
     print(histogram)
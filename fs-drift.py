@@ -1,4 +1,4 @@
-#!/usr/bin/python2
+#!/usr/bin/python3
 
 # fs-drift.py - user runs this module to generate workload
 # "-h" option generates online help
@@ -11,18 +11,53 @@ import random
 import event
 import fsop
 import common
-from common import rq, OK, NOTOK, BYTES_PER_KB, fsdrift_directory
+from common import rq, OK, NOTOK, BYTES_PER_KB, BYTES_PER_MB
 import opts
 import errno
-import subprocess
-
-# get byte counters from fsop
-
-
-def refresh_counters():
-    global counters
-    counters = {'read': fsop.read_bytes, 'create': fsop.write_bytes, 'append': fsop.write_bytes,
-                'random_write': fsop.randwrite_bytes, 'random_read': fsop.randread_bytes}
+import multiprocessing
+import threading
+import itertools
+import traceback
+import signal
+import coordinator
+import random_pool
+import optrace
+import numpy
+from histogram import latency_histogram, hist_len, print_latency_table
+from stats import counter_snapshot, stats_stream, summed_rates
+
+# counters that each worker publishes into its slot of the shared-memory array,
+# fsop counters first, then counters kept by the worker loop itself
+
+published_names = fsop.counter_names + ('last_center', 'total_errors', 'events', 'publish_time')
+published_count = len(published_names)
+publish_time_index = published_names.index('publish_time')
+
+# each worker also publishes one latency histogram per operation type,
+# followed by one per phase for operations that time their phases,
+# named like "create.open"
+
+op_names = [fsop.rq_map[opcode][1] for opcode in sorted(fsop.rq_map.keys())]
+phase_hist_names = dict([(name, ['%s.%s' % (name, phase) for phase in fsop.phase_names])
+                         for name in fsop.phased_op_names])
+hist_names = []
+for name in op_names:
+    hist_names.append(name)
+    hist_names.extend(phase_hist_names.get(name, []))
+hist_slot_len = len(hist_names) * hist_len
+
+# workers copy their counters into shared memory this often (seconds), at
+# multiples of it since the start, so that all workers publish together
+
+publish_interval = 0.5
+
+# byte counter in fsop.op_counters for each operation type that transfers data
+
+byte_counter_names = {'read': 'read_bytes', 'create': 'write_bytes', 'append': 'write_bytes',
+                      'random_write': 'randwrite_bytes', 'random_read': 'randread_bytes',
+                      'copy': 'copy_bytes', 'clone': 'clone_bytes',
+                      'preallocate': 'prealloc_bytes', 'punch_hole': 'punch_bytes',
+                      'zero_range': 'zero_bytes'}
 
 # instead of looking up before deletion, do reverse, delete and catch exception
 
@@ -34,10 +69,62 @@ def ensure_deleted(file_path):
         if e.errno != errno.ENOENT:
             raise e
 
+# copy this worker's counters into its slot of the shared array
+
+
+def publish_counters(shared, worker_id, thread_states):
+    slot = worker_id * published_count
+    total_errors = sum([st.errors for st in thread_states])
+    events = sum([st.events for st in thread_states])
+    values = fsop.get_counters() + [fsop.last_center, total_errors, events, time.time()]
+    shared[slot:slot + published_count] = values
+
+
+def publish_histograms(shared_hist, worker_id, thread_states):
+    slot = worker_id * hist_slot_len
+    for name in hist_names:
+        h = latency_histogram()
+        for st in thread_states:
+            h.merge(st.histograms[name])
+        shared_hist[slot:slot + hist_len] = h.values
+        slot += hist_len
+
+# return snapshot of counters for one worker, or summed across all workers
+
+
+def worker_counters(shared, worker_id):
+    slot = worker_id * published_count
+    return counter_snapshot(published_names, shared[slot:slot + published_count])
+
+
+def worker_snapshots(shared):
+    return [worker_counters(shared, w) for w in range(0, opts.workers)]
+
+# rates since earlier snapshots of every worker, each over its own window
+
+
+def worker_rates(snapshots, earlier):
+    return summed_rates([(s.delta(e), s['publish_time'] - e['publish_time'])
+                         for (s, e) in zip(snapshots, earlier)])
+
+
+def aggregate_histograms(shared_hist):
+    merged = [latency_histogram() for name in hist_names]
+    for w in range(0, opts.workers):
+        slot = w * hist_slot_len
+        for h in merged:
+            h.merge(latency_histogram(shared_hist[slot:slot + hist_len]))
+            slot += hist_len
+    return list(zip(hist_names, merged))
+
+
+def aggregate_counters(shared):
+    return counter_snapshot.merge(worker_snapshots(shared))
+
 # print out counters for the interval that just completed.
 
 
-def print_short_stats():
+def print_short_stats(c):
     print('elapsed time: %9.1f' % (time.time() - start_time))
     print('\n'\
         '%9u = center\n' \
@@ -46,12 +133,12 @@ def print_short_stats():
         '%9u = files random write\t' \
         '%9u = files read\n' \
         '%9u = files randomly read\n' \
-        % (fsop.last_center, fsop.have_created, fsop.have_appended, fsop.have_randomly_written,
-           fsop.have_read, fsop.have_randomly_read))
+        % (c['last_center'], c['have_created'], c['have_appended'], c['have_randomly_written'],
+           c['have_read'], c['have_randomly_read']))
     sys.stdout.flush()
 
 
-def print_stats():
+def print_stats(c):
     print()
     print('elapsed time: %9.1f' % (time.time() - start_time))
     print('\n\n'\
@@ -66,9 +153,25 @@ def print_stats():
         '%9u = files renamed\n' \
         '%9u = softlinks created\n' \
         '%9u = hardlinks created\n' \
-        % (fsop.last_center, fsop.have_created, fsop.have_appended, fsop.have_randomly_written,
-           fsop.have_read, fsop.have_randomly_read, fsop.have_truncated,
-           fsop.have_deleted, fsop.have_renamed, fsop.have_linked, fsop.have_hlinked))
+        '%9u = files copied\n' \
+        '%9u = files cloned\n' \
+        '%9u = files stat-ed\n' \
+        '%9u = softlinks lstat-ed\n' \
+        '%9u = directories listed\n' \
+        '%9u = xattrs read\n' \
+        '%9u = xattrs set\n' \
+        '%9u = files chmod-ed\n' \
+        '%9u = file times set\n' \
+        '%9u = files preallocated\n' \
+        '%9u = holes punched\n' \
+        '%9u = ranges zeroed\n' \
+        % (c['last_center'], c['have_created'], c['have_appended'], c['have_randomly_written'],
+           c['have_read'], c['have_randomly_read'], c['have_truncated'],
+           c['have_deleted'], c['have_renamed'], c['have_linked'], c['have_hlinked'],
+           c['have_copied'], c['have_cloned'], c['have_statted'], c['have_lstatted'],
+           c['have_listed_dirs'], c['have_getxattrs'], c['have_setxattrs'],
+           c['have_chmodded'], c['have_utimed'], c['have_preallocated'],
+           c['have_punched'], c['have_zeroed']))
 
     print('%9u = read requests\n' \
         '%9u = read bytes\n'\
@@ -78,151 +181,651 @@ def print_stats():
         '%9u = write bytes\n'\
         '%9u = random write requests\n' \
         '%9u = random write bytes\n' \
+        '%9u = copy bytes\n' \
+        '%9u = clone bytes\n' \
+        '%9u = copies done without copy_file_range\n' \
+        '%9u = clones done by copying\n' \
+        '%9u = preallocated bytes\n' \
+        '%9u = hole punched bytes\n' \
+        '%9u = zeroed bytes\n' \
         '%9u = fdatasync calls\n' \
         '%9u = fsync calls\n' \
         '%9u = leaf directories created\n' \
-        % (fsop.read_requests, fsop.read_bytes, fsop.randread_requests, fsop.randread_bytes,
-           fsop.write_requests, fsop.write_bytes, fsop.randwrite_requests, fsop.randwrite_bytes,
-           fsop.fdatasyncs, fsop.fsyncs, fsop.dirs_created))
+        '%9u = directory entries listed\n' \
+        % (c['read_requests'], c['read_bytes'], c['randread_requests'], c['randread_bytes'],
+           c['write_requests'], c['write_bytes'], c['randwrite_requests'], c['randwrite_bytes'],
+           c['copy_bytes'], c['clone_bytes'], c['copy_fallbacks'], c['clone_fallbacks'],
+           c['prealloc_bytes'], c['punch_bytes'], c['zero_bytes'],
+           c['fdatasyncs'], c['fsyncs'], c['dirs_created'], c['dir_entries']))
 
     print('%9u = no create -- file already existed\n'\
         '%9u = file not found\n'\
-        % (fsop.e_already_exists, fsop.e_file_not_found))
+        % (c['e_already_exists'], c['e_file_not_found']))
     print('%9u = no directory space\n'\
         '%9u = no space for new inode\n'\
         '%9u = no space for write data\n'\
-        % (fsop.e_no_dir_space, fsop.e_no_inode_space, fsop.e_no_space))
-    print('%9u = total errors' % total_errors)
+        '%9u = xattr not set\n'\
+        '%9u = operation not supported\n'\
+        % (c['e_no_dir_space'], c['e_no_inode_space'], c['e_no_space'],
+           c['e_no_xattr'], c['e_not_supported']))
+    print('%9.3f = seconds opening files\n'\
+        '%9.3f = seconds transferring data\n'\
+        '%9.3f = seconds in fsync\n'\
+        '%9.3f = seconds closing files\n'\
+        % (c['open_time'], c['io_time'], c['sync_time'], c['close_time']))
+    print('%9u = total errors' % c['total_errors'])
+    sys.stdout.flush()
+
+# print rates, as returned by worker_rates().
+# in open-loop mode, compare the operation rate with the target rate
+
+
+def print_rates(r):
+    print('%9.1f = ops/s\n%9.1f = read MB/s\n%9.1f = write MB/s' % (
+        r['ops'], r['read_mb'], r['write_mb']))
+    if opts.target_rate > 0:
+        print('%9.1f = target ops/s' % opts.target_rate)
+    print()
+    sys.stdout.flush()
+
+# print one line of counters per worker, so imbalance between workers is visible
+
+
+def print_worker_stats(shared):
+    print('%6s %10s %9s %9s %9s %12s %12s %7s' % (
+        'worker', 'ops', 'created', 'read', 'appended', 'read-bytes', 'write-bytes', 'errors'))
+    for w in range(0, opts.workers):
+        c = worker_counters(shared, w)
+        print('%6u %10u %9u %9u %9u %12u %12u %7u' % (
+            w, c['events'], c['have_created'], c['have_read'], c['have_appended'],
+            c['read_bytes'], c['write_bytes'], c['total_errors']))
     sys.stdout.flush()
 
+# exponentially distributed times between arrivals, in units of the mean,
+# for --arrival poisson
+
+arrival_pool = random_pool.random_pool(lambda n: numpy.random.standard_exponential(n))
+
+# counters kept by one operation thread of a worker, read by the
+# worker's main thread when it publishes them
+
+
+class op_thread_state:
+
+    def __init__(self):
+        self.events = 0
+        self.errors = 0
+        self.failed = False
+        self.parked = False
+        self.tracer = None
+        self.histograms = dict([(name, latency_histogram()) for name in hist_names])
+
+# split the time taken by an operation that opens a file into phases.
+# an operation that doesn't sync, or didn't transfer data, leaves the mark
+# for the end of that phase at 0
+
+
+def record_phases(st, c, name):
+    open_done = c.open_done
+    io_done = c.io_done or open_done
+    sync_done = c.sync_done or io_done
+    (open_name, io_name, sync_name, close_name) = phase_hist_names[name]
+    t = open_done - c.time_before
+    c.open_time += t
+    st.histograms[open_name].record(t)
+    t = io_done - open_done
+    c.io_time += t
+    st.histograms[io_name].record(t)
+    if c.sync_done:
+        t = sync_done - io_done
+        c.sync_time += t
+        st.histograms[sync_name].record(t)
+    t = c.time_after - sync_done
+    c.close_time += t
+    st.histograms[close_name].record(t)
+
+# the event loop run by each operation thread.  a worker runs --queue-depth
+# of these so that many operations can be in flight at once, since os.read()
+# and os.write() release the GIL.  the first thread to see that the test
+# is over tells the others through the stop event, except that a thread
+# replaying a trace leaves the others to finish their own traces.
+
+
+def run_ops(st, ctl, opcounter, rsptime_file, bw_file):
+    c = fsop.counters()
+    stop = ctl.stop
+    resume = ctl.resume
+    tracer = st.tracer
+    replaying = tracer is not None and tracer.replaying
+    recording = tracer is not None and not tracer.replaying
+
+    # in open-loop mode each thread issues operations on its own share of
+    # the target rate, starting at a random point in its first interval
+    # so that threads are not synchronized
+
+    thread_rate = opts.target_rate / (opts.workers * opts.queue_depth)
+    if thread_rate > 0:
+        next_start = time.time() + (fsop.fraction_pool.next_untraced() / thread_rate)
+
+    # replaying with the original timing, each operation is scheduled to
+    # start when it started in the recording, and latency is measured from
+    # then as in open-loop mode
+
+    replay_paced = replaying and opts.replay_timing == 'original'
+    paced = (thread_rate > 0) or replay_paced
+
+    while not stop.is_set():
+        # while paused, sleep until resumed or stopped
+
+        if not resume.is_set():
+            st.parked = True
+            resume.wait()
+            st.parked = False
+            if thread_rate > 0:
+                next_start = time.time()  # don't make up for time spent paused
+            continue
+
+        # in open-loop mode, wait until this operation is scheduled to start.
+        # if we are behind schedule, the operation starts at once, and the
+        # time it spent waiting counts towards its latency
+
+        if replaying:
+            op = tracer.next_op()
+            if op is None:
+                ctl.thread_done()
+                return
+            (op_time, x) = op
+            if replay_paced:
+                intended_start = start_time + op_time
+                delay = intended_start - time.time()
+                if (delay > 0) and stop.wait(delay):
+                    break
+        if (thread_rate > 0) and not replay_paced:
+            intended_start = next_start
+            delay = intended_start - time.time()
+            if (delay > 0) and stop.wait(delay):
+                break
+            if opts.arrival == 'poisson':
+                next_start += arrival_pool.next_untraced() / thread_rate
+            else:
+                next_start += 1.0 / thread_rate
+
+        # if using operation count to limit test
+
+        if opts.opcount > 0:
+            if next(opcounter) >= opts.opcount:
+                break
+
+        # if using duration to limit test
+
+        if opts.duration > 0:
+            elapsed = time.time() - start_time
+            if elapsed > opts.duration:
+                break
+        st.events += 1
+        if not replaying:
+            x = event.gen_event()
+        if recording:
+            if paced:
+                tracer.begin_op(intended_start - start_time, x)
+            else:
+                tracer.begin_op(time.time() - start_time, x)
+        (fn, name) = fsop.rq_map[x]
+        if common.verbosity & 0x1:
+            print()
+            print(x, name)
+        byte_counter = byte_counter_names.get(name)
+        if byte_counter:
+            bytes_before = getattr(c, byte_counter)
+        c.time_before = c.time_after = 0
+        c.open_done = c.io_done = c.sync_done = 0
+        rc = fn()
+        if recording:
+            tracer.end_op()
+        after = c.time_after
+        before = c.time_before
+
+        # an operation sets time_after only if it completed, so one that
+        # ended on an error or on a condition that is only counted (file not
+        # found, no space, not supported, ...) has no latency to record
+
+        if after:
+            if paced:
+                # measure from intended start to avoid coordinated omission
+                before = intended_start
+            total_time = float(after - before)
+            st.histograms[name].record(total_time)
+            if c.open_done:
+                record_phases(st, c, name)
+            if rsptime_file:
+                rsptime_file.write('%9.3f , %9.6f , %s\n' %
+                                   (before - start_time,  total_time, name))
+            if byte_counter and bw_file:
+                total_size = getattr(c, byte_counter) - bytes_before
+                bw_file.write('%9.3f , %9.6f , %s\n' % (
+                    before - start_time,  (total_size / total_time)/BYTES_PER_KB, name))
+        if rc != OK:
+            print("%s returns %d" % (name, rc))
+            st.errors += 1
+    ctl.stop_test()
+
+
+def run_op_thread(st, ctl, opcounter, rsptime_file, bw_file):
+    random_pool.trace_local.tracer = st.tracer
+    try:
+        run_ops(st, ctl, opcounter, rsptime_file, bw_file)
+    except Exception:
+        traceback.print_exc()
+        st.failed = True
+        ctl.stop_test()
+
+# how a worker is told to pause, resume, stop or re-read the workload table.
+# signal handlers and the pause and stop files only change this state, and
+# the operation threads only look at the two events, so there are no system
+# calls in the operation loop and paused threads sleep instead of spinning.
+#   SIGUSR1 = pause, SIGUSR2 = resume, SIGTERM = stop, SIGHUP = re-read workload
+
+
+class worker_control:
+
+    def __init__(self, thread_count):
+        self.stop = threading.Event()
+        self.resume = threading.Event()
+        self.resume.set()
+        self.paused_by_signal = False
+        self.paused = False  # threads parked and out of the top directory
+        self.reread_workload = False
+        self.threads_running = thread_count
+        self.lock = threading.Lock()
+
+    def stop_test(self):
+        self.stop.set()
+        self.resume.set()  # wake up paused threads so they see the stop
+
+    # a thread that reaches the end of its trace is done, and the test is
+    # over when every thread is
+
+    def thread_done(self):
+        with self.lock:
+            self.threads_running -= 1
+            if self.threads_running == 0:
+                self.stop_test()
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGUSR1:
+            self.paused_by_signal = True
+            self.resume.clear()
+        elif signum == signal.SIGUSR2:
+            self.paused_by_signal = False
+        elif signum == signal.SIGTERM:
+            self.stop_test()
+        elif signum == signal.SIGHUP:
+            self.reread_workload = True
+
+    # called by the worker's main thread every publish interval
+
+    def poll(self, thread_states, threads):
+        if os.access(stop_file, os.R_OK):
+            self.stop_test()
+        if (opts.duration > 0) and (time.time() - start_time > opts.duration):
+            self.stop_test()
+        if self.stop.is_set():
+            return
+
+        if self.reread_workload:
+            self.reread_workload = False
+            event.parse_weights()
+            event.normalize_weights()
+
+        # while paused, get out of the working directory so the filesystem
+        # under test isn't held busy, once no operation is in progress
+
+        paused = self.paused_by_signal or os.path.isfile(pause_file)
+        if paused and not self.paused:
+            self.resume.clear()
+            while not self.stop.is_set() and not all(
+                    [st.parked or not t.is_alive() for (st, t) in zip(thread_states, threads)]):
+                time.sleep(0.01)
+            os.chdir('/var/tmp')
+            self.paused = True
+        elif not paused and not self.resume.is_set():
+            if self.paused:
+                os.chdir(top_directory)
+                self.paused = False
+            self.resume.set()
+
+control_signals = (signal.SIGUSR1, signal.SIGUSR2, signal.SIGTERM, signal.SIGHUP)
+
+# counters that each prefill worker publishes into its slot of a shared array
+
+prefill_names = ('have_created', 'write_bytes', 'e_already_exists')
+
+# before the drift phase, each worker creates a --prefill fraction of the
+# files in its share of the file index range, in chunks of consecutive indices
+
+
+def run_prefill(worker_id, shared_prefill):
+    fsop.reseed()
+    fsop.init_buf()
+    c = fsop.counters()
+    slot = worker_id * len(prefill_names)
+    limit = fsop.file_index_limit()
+    chunk = random_pool.BLOCK_SIZE
+    try:
+        for first in range(worker_id * chunk, limit, opts.workers * chunk):
+            indices = numpy.arange(first, min(first + chunk, limit))
+            selected = indices[numpy.random.random_sample(len(indices)) < opts.prefill]
+            for file_index in selected.tolist():
+                fsop.prefill_file(file_index)
+            shared_prefill[slot:slot + len(prefill_names)] = \
+                [getattr(c, n) for n in prefill_names]
+    except OSError as e:
+        if e.errno != errno.ENOSPC:
+            raise e
+        print('prefill worker %d: no space left, stopping' % worker_id)
+    shared_prefill[slot:slot + len(prefill_names)] = \
+        [getattr(c, n) for n in prefill_names]
+
+
+def prefill(mp):
+    before_prefill = time.time()
+    shared_prefill = mp.Array('d', opts.workers * len(prefill_names), lock=False)
+    prefillers = [mp.Process(target=run_prefill, args=(w, shared_prefill))
+                  for w in range(0, opts.workers)]
+    for p in prefillers:
+        p.start()
+    for p in prefillers:
+        p.join()
+        if p.exitcode != OK:
+            print('prefill worker pid %d exit status %d' % (p.pid, p.exitcode))
+            sys.exit(NOTOK)
+    total = counter_snapshot.merge(
+        [counter_snapshot(prefill_names, shared_prefill[w * len(prefill_names):(w + 1) * len(prefill_names)])
+         for w in range(0, opts.workers)])
+    elapsed = time.time() - before_prefill
+    print('prefill created %d files, %d bytes in %.2f sec (%.1f MB/s), %d already existed' % (
+        total['have_created'], total['write_bytes'], elapsed,
+        total['write_bytes'] / elapsed / BYTES_PER_MB, total['e_already_exists']))
+    sys.stdout.flush()
+
+# each worker process runs its operation threads, and its main thread
+# publishes their counters to the parent through the shared arrays
+
+
+def run_worker(worker_id, shared, shared_hist):
+    fsop.reseed()
+    fsop.worker_id = worker_id
+    rsptime_file = None
+    bw_file = None
+
+    if opts.rsptimes:
+        rsptime_filename = '/var/tmp/fs-drift_%d_%d_rspt.csv' % (
+            int(time.time()), os.getpid())
+        rsptime_file = open(rsptime_filename, "w")
+
+    if opts.bw:
+        bw_filename = '/var/tmp/fs-drift_%d_%d_bw.csv' % (
+            int(time.time()), os.getpid())
+        bw_file = open(bw_filename, "w")
+
+    fsop.init_buf()
+
+    ctl = worker_control(opts.queue_depth)
+    for signum in control_signals:
+        signal.signal(signum, ctl.handle_signal)
+    opcounter = itertools.count()
+    thread_states = [op_thread_state() for t in range(0, opts.queue_depth)]
+    for (k, st) in enumerate(thread_states):
+        st.tracer = open_tracer(worker_id, k)
+    threads = [threading.Thread(target=run_op_thread,
+                                args=(st, ctl, opcounter, rsptime_file, bw_file))
+               for st in thread_states]
+    for t in threads:
+        t.start()
+
+    last_drift_time = time.time()
+    try:
+        while not ctl.stop.wait(publish_interval - ((time.time() - start_time) % publish_interval)):
+            publish_counters(shared, worker_id, thread_states)
+            publish_histograms(shared_hist, worker_id, thread_states)
+            ctl.poll(thread_states, threads)
+            now = time.time()
+            if (opts.drift_time > 0) and (now - last_drift_time > opts.drift_time):
+                fsop.advance_simulated_time(opts.drift_time)
+                last_drift_time = now
+    except KeyboardInterrupt:
+        print("received SIGINT (control-C) signal, aborting...")
+        ctl.stop_test()
+    for t in threads:
+        t.join()
+
+    publish_counters(shared, worker_id, thread_states)
+    publish_histograms(shared_hist, worker_id, thread_states)
+    fsop.save_simulated_time()
+
+    if opts.rsptimes:
+        rsptime_file.close()
+        print('response time file is %s' % rsptime_filename)
+
+    if opts.bw:
+        bw_file.close()
+        print('bandwidth file is %s' % bw_filename)
+
+    for st in thread_states:
+        if st.tracer:
+            st.tracer.close()
+            report_trace(st.tracer)
+
+    if any([st.failed for st in thread_states]):
+        sys.exit(NOTOK)
+
+# each operation thread records or replays its own trace file
+
+
+def trace_prefix():
+    return os.path.join(launch_directory, opts.record_trace or opts.replay_trace)
+
+
+def open_tracer(worker_id, thread_index):
+    if opts.record_trace:
+        return optrace.trace_recorder(optrace.trace_pathname(trace_prefix(), worker_id, thread_index))
+    if opts.replay_trace:
+        return optrace.trace_replayer(optrace.trace_pathname(trace_prefix(), worker_id, thread_index))
+    return None
+
+
+def report_trace(tracer):
+    if tracer.replaying:
+        print('replayed %d operations from %s, %d random values not in the trace were generated' % (
+            tracer.ops, tracer.pathname, tracer.misses))
+    else:
+        print('recorded %d operations in %s' % (tracer.ops, tracer.pathname))
+
 # the main program
 
 
 opts.parseopts()
 event.parse_weights()
 event.normalize_weights()
-total_errors = 0
+fsop.init_access_dist()
+fsop.init_io_engine()
+random_pool.tracing = bool(opts.record_trace or opts.replay_trace)
+
 
+# relative pathnames given on the command line are relative to here
+
+launch_directory = os.getcwd()
 
 try:
     os.mkdir(opts.top_directory)
 except os.error as e:
     if e.errno != errno.EEXIST:
         raise e
-if opts.rsptimes:
-    rsptime_filename = '/var/tmp/fs-drift_%d_%d_rspt.csv' % (
-        int(time.time()), os.getpid())
-    rsptime_file = open(rsptime_filename, "w")
-
-if opts.bw:
-    bw_filename = '/var/tmp/fs-drift_%d_%d_bw.csv' % (
-        int(time.time()), os.getpid())
-    bw_file = open(bw_filename, "w")
-
-#build lzdatagen
-if opts.compression_ratio != 0.0:
-    os.chdir(fsdrift_directory+'/lzdatagen')
-    subprocess.call('make', shell=True)
 
 os.chdir(opts.top_directory)
 sys.stdout.flush()
 
-op = 0
+# absolute paths, since workers leave the top directory while paused
 
-last_stat_time = time.time()
-last_drift_time = time.time()
-stop_file = opts.top_directory + os.sep + 'stop-file'
+top_directory = os.getcwd()
+fsop.init_simulated_time(top_directory)
+stop_file = os.path.join(top_directory, 'stop-file')
+pause_file = os.path.join(launch_directory, opts.pause_file)
 
-# we have to synchronize threads across multiple hosts somehow, we do this with a
-# file in a shared file system.
+# workers inherit the result, so this is only tried once per run
 
-if opts.starting_gun_file:
-    while not os.access(opts.starting_gun_file, os.R_OK):
-        time.sleep(1)
-time.sleep(2)  # give everyone else a chance to see that start-file is there
+fsop.init_direct_io()
+
+# a replay needs a trace file for every operation thread, so it must use
+# the same --workers and --queue-depth as the recording
+
+if opts.replay_trace:
+    for w in range(0, opts.workers):
+        for k in range(0, opts.queue_depth):
+            pathname = optrace.trace_pathname(trace_prefix(), w, k)
+            if not os.path.isfile(pathname):
+                print('no trace file %s, replay with the --workers and --queue-depth of the recording' %
+                      pathname)
+                sys.exit(NOTOK)
+
+# build the directory tree before the starting gun, so creates don't have to,
+# workers inherit the set of directories known to exist
+
+if opts.precreate_dirs > 0:
+    before_precreate = time.time()
+    dirs_precreated = fsop.precreate_dirs(opts.precreate_dirs)
+    print('%d directories created in %.2f sec' % (
+        dirs_precreated, time.time() - before_precreate))
+    sys.stdout.flush()
+
+mp = multiprocessing.get_context('fork')
+
+# fill the namespace with files before the starting gun, so that the drift
+# phase doesn't start by measuring mostly "file not found"
+
+if opts.prefill > 0:
+    prefill(mp)
+
+# we have to synchronize threads across multiple hosts somehow, we do this either
+# with a controller that tells every agent to start, or with a file in a shared
+# file system.
+
+controller = None
+if opts.controller:
+    controller = coordinator.agent_connection(opts.controller)
+    controller.hello(opts.workers)
+    controller.wait_for_start()
+else:
+    if opts.starting_gun_file:
+        while not os.access(opts.starting_gun_file, os.R_OK):
+            time.sleep(1)
+    time.sleep(2)  # give everyone else a chance to see that start-file is there
 start_time = time.time()
-event_count = 0
 
-fsop.init_buf()
+# workers are forked so they inherit parsed options and the workload table,
+# each worker owns one slot of published_count counters in the shared array
+
+# workers ignore control signals until they have installed their own handlers,
+# then the parent passes control signals on to every worker
+
+def forward_signal(signum, frame):
+    for p in workers:
+        if p.is_alive():
+            os.kill(p.pid, signum)
+
+for signum in control_signals:
+    signal.signal(signum, signal.SIG_IGN)
+
+shared = mp.Array('d', opts.workers * published_count, lock=False)
+for w in range(0, opts.workers):
+    shared[w * published_count + publish_time_index] = start_time
+start_snapshots = worker_snapshots(shared)
+shared_hist = mp.Array('d', opts.workers * hist_slot_len, lock=False)
+workers = [mp.Process(target=run_worker, args=(w, shared, shared_hist))
+           for w in range(0, opts.workers)]
+for p in workers:
+    p.start()
+for signum in control_signals:
+    signal.signal(signum, forward_signal)
+print('fs-drift pid %d, send SIGUSR1 to pause, SIGUSR2 to resume, '
+      'SIGTERM to stop, SIGHUP to re-read workload table' % os.getpid())
+sys.stdout.flush()
 
-while True:
-    # if there is pause file present, do jump out of working directory
+# the stream is opened in the parent only, after the workers are forked.
+# it gets a record for every report interval and one for the rest of the run
 
-    if os.path.isfile(opts.pause_file):
-        if os.getcwd() != '/var/tmp':
-            os.chdir('/var/tmp')
-        continue
-    elif os.getcwd() == '/var/tmp':
-        os.chdir(opts.top_directory)
-
-    # every 1000 events, check for "stop file" that indicates test should end
-
-    event_count += 1
-    if (event_count % 1000 == 0) and os.access(stop_file, os.R_OK):
-        break
-
-    # if using operation count to limit test
-
-    if opts.opcount > 0:
-        if op >= opts.opcount:
-            break
-        op += 1
-
-    # if using duration to limit test
-
-    if opts.duration > 0:
-        elapsed = time.time() - start_time
-        if elapsed > opts.duration:
-            break
-    x = event.gen_event()
-    (fn, name) = fsop.rq_map[x]
-    if common.verbosity & 0x1:
-        print()
-        print(x, name)
-    before_drift = time.time()
-    curr_e_exists, curr_e_not_found = fsop.e_already_exists, fsop.e_file_not_found
-    refresh_counters()
-    if name in counters:
-        bytes_before = counters[name]
-    try:
-        rc = fn()
-        after = fsop.time_after
-        before = fsop.time_before
-        if curr_e_exists == fsop.e_already_exists and curr_e_not_found == fsop.e_file_not_found:
-            total_time = float(after - before)
-            if opts.rsptimes:
-                rsptime_file.write('%9.3f , %9.6f , %s\n' %
-                                   (before - start_time,  total_time, name))
-            if name in counters and opts.bw:
-                refresh_counters()
-                total_size = counters[name] - bytes_before
-                bw_file.write('%9.3f , %9.6f , %s\n' % (
-                    before - start_time,  (total_size / total_time)/BYTES_PER_KB, name))
-    except KeyboardInterrupt as e:
-        print("received SIGINT (control-C) signal, aborting...")
-        break
-    if rc != OK:
-        print("%s returns %d" % (name, rc))
-        total_errors += 1
-    if (opts.stats_report_interval > 0) and (before - last_stat_time > opts.stats_report_interval):
-        if opts.short_stats == True:
-            print_short_stats()
-        else:
-            print_stats()
-        last_stat_time = before
-    if (opts.drift_time > 0) and (before_drift - last_drift_time > opts.drift_time):
-        fsop.simulated_time += opts.drift_time
-        last_drift_time = before_drift
-
-if opts.rsptimes:
-    rsptime_file.close()
-    print('response time file is %s' % rsptime_filename)
-
-if opts.bw:
-    bw_file.close()
-    print('bandwidth file is %s' % bw_filename)
-
-print_stats()
+stream = None
+if opts.stats_stream:
+    stream = stats_stream(os.path.join(launch_directory, opts.stats_stream), opts.stats_format,
+                          published_names, hist_names)
+empty_histograms = [(name, latency_histogram()) for name in hist_names]
+
+
+def write_stream_record(now, c, r, h):
+    interval_hists = [(name, hist.delta(last_hist))
+                      for ((name, hist), (last_name, last_hist)) in zip(h, last_stat_hists)]
+    stream.write(now, now - start_time, now - last_stat_time,
+                 c.delta(last_stat_counters), r, interval_hists)
+
+
+last_stat_time = start_time
+last_stat_counters = counter_snapshot.merge(start_snapshots)
+last_stat_snapshots = start_snapshots
+last_stat_hists = empty_histograms
+last_controller_time = start_time
+try:
+    while any(p.is_alive() for p in workers):
+        time.sleep(publish_interval)
+        now = time.time()
+        if controller and (now - last_controller_time > coordinator.agent_report_interval):
+            c = aggregate_counters(shared)
+            controller.send_counters(c['publish_time'] - start_time, c.as_dict())
+            last_controller_time = now
+        if (opts.stats_report_interval > 0) and (now - last_stat_time > opts.stats_report_interval):
+            snapshots = worker_snapshots(shared)
+            c = counter_snapshot.merge(snapshots)
+            r = worker_rates(snapshots, last_stat_snapshots)
+            h = aggregate_histograms(shared_hist)
+            if opts.short_stats == True:
+                print_short_stats(c)
+            else:
+                print_stats(c)
+            print_rates(r)
+            print_latency_table(h)
+            if opts.workers > 1:
+                print_worker_stats(shared)
+            if stream:
+                write_stream_record(now, c, r, h)
+            last_stat_time = now
+            last_stat_counters = c
+            last_stat_snapshots = snapshots
+            last_stat_hists = h
+except KeyboardInterrupt:
+    print("received SIGINT (control-C) signal, waiting for workers...")
+
+worker_failed = False
+for p in workers:
+    p.join()
+    if p.exitcode != OK:
+        print('worker pid %d exit status %d' % (p.pid, p.exitcode))
+        worker_failed = True
+
+snapshots = worker_snapshots(shared)
+c = counter_snapshot.merge(snapshots)
+h = aggregate_histograms(shared_hist)
+print_stats(c)
+print_rates(worker_rates(snapshots, start_snapshots))
+print_latency_table(h)
+if opts.workers > 1:
+    print_worker_stats(shared)
+if controller:
+    controller.send_done(c['publish_time'] - start_time, c.as_dict(), h)
+    controller.close()
+if stream:
+    write_stream_record(time.time(), c, worker_rates(snapshots, last_stat_snapshots), h)
+    stream.close()
 if opts.starting_gun_file:
     ensure_deleted(opts.starting_gun_file)
 ensure_deleted(stop_file)
+if worker_failed:
+    sys.exit(NOTOK)
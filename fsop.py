@@ -13,44 +13,119 @@ import common
 from common import rq, file_access_dist, verbosity, OK, NOTOK, BYTES_PER_KB, FD_UNDEFINED
 import opts
 import numpy  # for gaussian distribution
-import subprocess
-
-# operation counters, incremented by op function below
-have_created = 0
-have_deleted = 0
-have_linked = 0
-have_written = 0
-have_appended = 0
-have_randomly_written = 0
-have_read = 0
-have_randomly_read = 0
-have_renamed = 0
-have_truncated = 0
-have_hlinked = 0
-
-# throughput counters
-read_requests = 0
-read_bytes = 0
-randread_requests = 0
-randread_bytes = 0
-write_requests = 0
-write_bytes = 0
-randwrite_requests = 0
-randwrite_bytes = 0
-fsyncs = 0
-fdatasyncs = 0
-dirs_created = 0
-
-# time counters
-time_before = 0
-time_after = 0
-
-# error counters
-e_already_exists = 0
-e_file_not_found = 0
-e_no_dir_space = 0
-e_no_inode_space = 0
-e_no_space = 0
+import random_pool
+import access_dist
+import threading
+import itertools
+import mmap
+import struct
+import fcntl
+import ctypes
+import zlib
+from multiprocessing.pool import ThreadPool
+
+# names of the counters below, in the order in which a worker publishes them
+# to the parent process (see fs-drift.py)
+
+counter_names = (
+    'have_created', 'have_deleted', 'have_linked', 'have_written', 'have_appended',
+    'have_randomly_written', 'have_read', 'have_randomly_read', 'have_renamed',
+    'have_truncated', 'have_hlinked', 'have_copied', 'have_cloned',
+    'have_statted', 'have_lstatted', 'have_listed_dirs', 'have_getxattrs',
+    'have_setxattrs', 'have_chmodded', 'have_utimed',
+    'have_preallocated', 'have_punched', 'have_zeroed',
+    'read_requests', 'read_bytes', 'randread_requests', 'randread_bytes',
+    'write_requests', 'write_bytes', 'randwrite_requests', 'randwrite_bytes',
+    'copy_bytes', 'clone_bytes', 'copy_fallbacks', 'clone_fallbacks',
+    'prealloc_bytes', 'punch_bytes', 'zero_bytes',
+    'fsyncs', 'fdatasyncs', 'dirs_created', 'dir_entries',
+    'open_time', 'io_time', 'sync_time', 'close_time',
+    'e_already_exists', 'e_file_not_found', 'e_no_dir_space', 'e_no_inode_space',
+    'e_no_space', 'e_no_xattr', 'e_not_supported')
+
+# times marked by an operation, see run_ops() in fs-drift.py
+
+mark_names = ('time_before', 'open_done', 'io_done', 'sync_done', 'time_after')
+
+# counters for the operations done by one thread, incremented by op functions
+# below.  each thread that runs operations (see --queue-depth) gets its own
+# op_counters from counters(), so threads never update the same counter,
+# and get_counters() adds them up.  __slots__ makes the counters compact and
+# quick to update, and catches a misspelled counter name.
+
+
+class op_counters:
+
+    __slots__ = counter_names + mark_names
+
+    def __init__(self):
+        # operation counters
+        self.have_created = 0
+        self.have_deleted = 0
+        self.have_linked = 0
+        self.have_written = 0
+        self.have_appended = 0
+        self.have_randomly_written = 0
+        self.have_read = 0
+        self.have_randomly_read = 0
+        self.have_renamed = 0
+        self.have_truncated = 0
+        self.have_hlinked = 0
+        self.have_copied = 0
+        self.have_cloned = 0
+        self.have_statted = 0
+        self.have_lstatted = 0
+        self.have_listed_dirs = 0
+        self.have_getxattrs = 0
+        self.have_setxattrs = 0
+        self.have_chmodded = 0
+        self.have_utimed = 0
+        self.have_preallocated = 0
+        self.have_punched = 0
+        self.have_zeroed = 0
+
+        # throughput counters
+        self.read_requests = 0
+        self.read_bytes = 0
+        self.randread_requests = 0
+        self.randread_bytes = 0
+        self.write_requests = 0
+        self.write_bytes = 0
+        self.randwrite_requests = 0
+        self.randwrite_bytes = 0
+        self.copy_bytes = 0
+        self.clone_bytes = 0
+        self.copy_fallbacks = 0
+        self.clone_fallbacks = 0
+        self.prealloc_bytes = 0
+        self.punch_bytes = 0
+        self.zero_bytes = 0
+        self.fsyncs = 0
+        self.fdatasyncs = 0
+        self.dirs_created = 0
+        self.dir_entries = 0
+
+        # time counters.  an operation that opens a file also marks the end
+        # of its open, data transfer and sync phases, and fs-drift.py adds up
+        # the seconds spent in each phase, with close being the rest
+        self.time_before = 0
+        self.open_done = 0
+        self.io_done = 0
+        self.sync_done = 0
+        self.time_after = 0
+        self.open_time = 0.0
+        self.io_time = 0.0
+        self.sync_time = 0.0
+        self.close_time = 0.0
+
+        # error counters
+        self.e_already_exists = 0
+        self.e_file_not_found = 0
+        self.e_no_dir_space = 0
+        self.e_no_inode_space = 0
+        self.e_no_space = 0
+        self.e_no_xattr = 0
+        self.e_not_supported = 0
 
 # most recent center
 last_center = 0
@@ -59,76 +134,407 @@ last_center = 0
 # someday these two should be parameters
 total_dirs = 1
 
+# leaf directory pathnames, indexed by (file_index * large_prime) % total_dirs,
+# built once so that a pathname costs one table lookup and one format
+# instead of a loop over directory levels.  it has one entry per leaf
+# directory, not per file, so it stays small for any --max-files
+
+dir_table = None
+
+# leaf directories known to exist, so create() only has to look one up
+# the first time a file is created in it.  fs-drift never removes directories.
+
+known_dirs = set()
+
 link_suffix = '.s'
 hlink_suffix = '.h'
 rename_suffix = '.r'
 
+# write buffer, generated once at startup and written through memoryview
+# slices so no operation allocates or copies data.  a record written at file
+# offset N comes from buf_ring offset (B + N) modulo buf_ring, so the buffer
+# is buf_ring bytes plus one maximum-sized record long.  B is drawn for each
+# operation by random_buf_base(), so that files don't all hold the same data
+# at the same offsets
+
 buf = None
+buf_view = None
+buf_ring = 0
+min_buf_ring = 1 << 20
+
+# with --direct, files are opened with O_DIRECT, which needs buffer addresses,
+# file offsets and transfer sizes that are multiples of the device's logical
+# block size.  DIRECT_ALIGN satisfies every common device.  buffers then come
+# from anonymous mmaps, which are page-aligned, and reads go into read_buf
+# instead of a newly allocated bytes object.  direct_io is turned off by
+# init_direct_io() if the filesystem doesn't support O_DIRECT (e.g. tmpfs)
+
+DIRECT_ALIGN = 4096
+direct_io = False
+read_buf = None
+read_view = None
+
+# operations that --io-engine mmap replaces, see init_io_engine()
+
+IO_ENGINE_SYSCALL = 'syscall'
+IO_ENGINE_MMAP = 'mmap'
 
 large_prime = 12373
 
 # for gaussian distribution with moving mean, we need to remember simulated time
 # so we can pick up where we left off with moving mean
 
-simtime_pathname = '/var/tmp/fs-drift-simtime.tmp'
+# each worker keeps its simulated time in its own small file, mapped into
+# memory, so saving it is a store to memory instead of a file write, and
+# workers don't overwrite each other's time.  the kernel writes it back,
+# and save_simulated_time() flushes it when the worker finishes.  the file
+# name includes a hash of the top directory, so that fs-drift runs on
+# different directories at the same time don't share a simulated time,
+# while later runs on the same directory resume it.
+
+simtime_pathname_format = '/var/tmp/fs-drift-simtime.%s.%d.tmp'
+simtime_key = None
+SIMTIME_FORMAT = 'q'
+SIMTIME_SIZE = struct.calcsize(SIMTIME_FORMAT)
 SIMULATED_TIME_UNDEFINED = None
 simulated_time = SIMULATED_TIME_UNDEFINED  # initialized later
-time_save_rate = 5
+simtime_map = None
 
-def init_buf():
-    global buf
-    buf = random_buffer.gen_buffer(opts.max_record_size_kb*BYTES_PER_KB)
+thread_local = threading.local()
+thread_counters = []
+
+
+def counters():
+    try:
+        return thread_local.counters
+    except AttributeError:
+        c = op_counters()
+        thread_local.counters = c
+        thread_counters.append(c)
+        return c
+
+
+def get_counters():
+    return [sum([getattr(c, n) for c in thread_counters]) for n in counter_names]
+
+
+def reset_counters():
+    global thread_local
+    thread_local = threading.local()
+    del thread_counters[:]
+
+# a forked worker inherits the parent's random state, so every worker
+# would generate the same sequence of events and filenames unless reseeded
+
+def reseed():
+    random.seed()
+    numpy.random.seed()
+    random_pool.reset_all()
+    reset_counters()
 
-def refresh_buf(size):
-    global buf
-    buf = random_buffer.gen_buffer(size)
+# random values used by every operation are drawn in blocks from these pools,
+# the pools read opts when they generate a block so are only used after parseopts()
+
+
+def max_files_per_dir():
+    if dir_table is None:  # if first time
+        init_dir_table()
+    return opts.max_files // total_dirs
+
+# compute the constants for the file access distribution, once, before
+# workers are forked
+
+def init_access_dist():
+    if opts.rand_distr_type in (file_access_dist.ZIPF, file_access_dist.LATEST):
+        access_dist.init_zipf(opts.max_files, opts.zipf_theta)
+
+# for the "latest" distribution, creates use consecutive file indices,
+# interleaved between workers, and other operations pick a zipf-distributed
+# distance back from the most recently created index
+
+worker_id = 0
+create_sequence = itertools.count()
+latest_index = 0
+
+
+def next_latest_create():
+    global latest_index
+    latest_index = ((next(create_sequence) * opts.workers) + worker_id) % opts.max_files
+    return latest_index
+
+# number of file indices that gen_random_fn() can return
+
+
+def file_index_limit():
+    if opts.rand_distr_type == file_access_dist.UNIFORM:
+        return max_files_per_dir() + 1
+    return opts.max_files
+
+
+uniform_index_pool = random_pool.random_pool(
+    lambda n: numpy.random.randint(0, max_files_per_dir() + 1, n), traced=False)
+gaussian_pool = random_pool.random_pool(
+    lambda n: numpy.random.standard_normal(n), traced=False)
+file_size_pool = random_pool.random_pool(
+    lambda n: numpy.random.randint(1, (opts.max_file_size_kb * BYTES_PER_KB) + 1, n))
+record_size_pool = random_pool.random_pool(
+    lambda n: numpy.random.randint(1, (opts.max_record_size_kb * BYTES_PER_KB) + 1, n), traced=False)
+zipf_pool = random_pool.random_pool(access_dist.gen_zipf_block, traced=False)
+hotspot_pool = random_pool.random_pool(access_dist.gen_hotspot_block, traced=False)
+fraction_pool = random_pool.random_pool(
+    lambda n: numpy.random.random_sample(n))
+percent_pool = random_pool.random_pool(
+    lambda n: numpy.random.randint(0, 101, n))
+
+def max_record_size():
+    return max(opts.max_record_size_kb, opts.fix_record_size_kb) * BYTES_PER_KB
+
+def direct_align(sz):
+    return ((sz + DIRECT_ALIGN - 1) // DIRECT_ALIGN) * DIRECT_ALIGN
+
+
+def init_buf():
+    global buf, buf_view, buf_ring, read_buf, read_view
+    buf_ring = max(max_record_size(), min_buf_ring)
+    if not direct_io:
+        buf = random_buffer.gen_buffer(buf_ring + max_record_size())
+        buf_view = memoryview(buf)
+        read_buf = bytearray(max_record_size())
+        read_view = memoryview(read_buf)
+        return
+    buf_ring = direct_align(buf_ring)
+    record_sz = direct_align(max_record_size())
+    data = random_buffer.gen_buffer(buf_ring + record_sz)
+    buf = mmap.mmap(-1, len(data))
+    buf[0:len(data)] = data
+    buf_view = memoryview(buf)
+    read_buf = mmap.mmap(-1, record_sz)
+    read_view = memoryview(read_buf)
+
+# find out if O_DIRECT works in the current directory by writing and reading
+# one aligned block, and fall back to buffered I/O if it doesn't
+
+
+def init_direct_io():
+    global direct_io
+    if not opts.direct:
+        return
+    probe_fn = 'fs-drift-direct-probe.tmp'
+    probe = mmap.mmap(-1, DIRECT_ALIGN)
+    fd = FD_UNDEFINED
+    try:
+        fd = os.open(probe_fn, os.O_CREAT | os.O_RDWR | os.O_DIRECT, 0o644)
+        os.write(fd, probe)
+        os.lseek(fd, 0, 0)
+        os.readv(fd, [probe])
+        direct_io = True
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise e
+        print('O_DIRECT not supported in %s, using buffered I/O' % os.getcwd())
+    finally:
+        if fd != FD_UNDEFINED:
+            os.close(fd)
+        if os.path.exists(probe_fn):
+            os.unlink(probe_fn)
+
+# open flags for file data operations
+
+
+def data_open_flags(flags):
+    if direct_io:
+        return flags | os.O_DIRECT
+    return flags
+
+# data is read into read_buf, which is allocated once, instead of into a new
+# bytes object per call.  the contents are never looked at, so every thread
+# in a worker reads into the same buffer.
+
+# read up to size bytes at the current offset, return the byte count
+
+
+def read_record(fd, size):
+    return os.readv(fd, [read_view[0:size]])
+
+# random reads and writes split a segment into records of the usual sizes,
+# then transfer the whole segment with one preadv() or pwritev() at its
+# offset (or a few, if it has more than iov_max records), instead of an
+# lseek() and a read() or write() per record
+
+iov_max = os.sysconf('SC_IOV_MAX')
+
+
+def record_sizes(targetsz):
+    sizes = []
+    total = 0
+    while total < targetsz:
+        recsz = min(get_recsz(), targetsz - total)
+        sizes.append(recsz)
+        total += recsz
+    return sizes
+
+# returns bytes read, less than the segment size at end of file
+
+
+def pread_segment(fd, off, sizes):
+    total = 0
+    for first in range(0, len(sizes), iov_max):
+        iov = [read_view[0:recsz] for recsz in sizes[first:first + iov_max]]
+        expected = sum(sizes[first:first + iov_max])
+        count = os.preadv(fd, iov, off + total)
+        total += count
+        if count < expected:
+            break
+    return total
+
+
+def pwrite_segment(fd, off, sizes, base):
+    total = 0
+    for first in range(0, len(sizes), iov_max):
+        iov = []
+        pos = off + total
+        for recsz in sizes[first:first + iov_max]:
+            iov.append(buf_slice(base + pos, recsz))
+            pos += recsz
+        count = os.pwritev(fd, iov, off + total)
+        assert count > 0
+        total += count
+    return total
+
+def buf_slice(offset, size):
+    start = offset % buf_ring
+    return buf_view[start:start + size]
+
+
+def random_buf_base():
+    return random_seek_offset(buf_ring)
 
 def scallerr(msg, fn, syscall_exception):
     err = syscall_exception.errno
-    a = subprocess.Popen("date", shell=True,
-                         stdout=subprocess.PIPE).stdout.read()
+    now = time.strftime('%a %b %d %H:%M:%S %Z %Y')  # same format as date(1)
     print('%s ERROR: %s: %s syscall errno %d(%s)' % (
-        a.rstrip('\n'), msg, fn, err, os.strerror(err)))
+        now, msg, fn, err, os.strerror(err)))
+
+
+def init_dir_table():
+    global total_dirs, dir_table
+    total_dirs = opts.dirs_per_level ** opts.levels
+    table = []
+    for dir_index in range(0, total_dirs):
+        d = '.'
+        index = dir_index
+        for j in range(0, opts.levels):
+            subdir_index = 1 + (index % opts.dirs_per_level)
+            dname = 'd%04d' % subdir_index
+            d = os.path.join(d, dname)
+            index //= opts.dirs_per_level
+        table.append(d)
+    dir_table = table
 
 
 def gen_random_dirname(file_index):
-    d = '.'
+    if dir_table is None:
+        init_dir_table()
     # multiply file_index ( < opts.max_files) by large number relatively prime to dirs_per_level
-    index = file_index * large_prime
-    for j in range(0, opts.levels):
-        subdir_index = 1 + (index % opts.dirs_per_level)
-        dname = 'd%04d' % subdir_index
-        d = os.path.join(d, dname)
-        index /= opts.dirs_per_level
-    return d
+    return dir_table[(file_index * large_prime) % total_dirs]
 
 
-def gen_random_fn(is_create=False):
-    global total_dirs
+def gen_file_path(file_index):
+    return gen_random_dirname(file_index) + os.sep + ('f%09d' % file_index)
+
+
+# every leaf directory that gen_random_dirname() can return
+
+
+def gen_all_dirnames():
+    if dir_table is None:
+        init_dir_table()
+    return list(dir_table)
+
+# create the whole directory tree with parallel threads, before the test
+# starts, and remember that it exists.  returns number of directories created
+
+
+def precreate_dirs(thread_count):
+    def mkdir_leaf(d):
+        if os.path.isdir(d):
+            return 0
+        os.makedirs(d, exist_ok=True)
+        return 1
+
+    dirnames = gen_all_dirnames()
+    pool = ThreadPool(thread_count)
+    try:
+        created = sum(pool.map(mkdir_leaf, dirnames))
+    finally:
+        pool.close()
+        pool.join()
+    known_dirs.update(dirnames)
+    return created
+
+
+# called with the absolute path of the top directory before workers are forked
+
+
+def init_simulated_time(top_directory):
+    global simtime_key
+    simtime_key = '%08x' % zlib.crc32(top_directory.encode())
+
+
+def load_simulated_time():
+    global simulated_time, simtime_map
+    fd = os.open(simtime_pathname_format % (simtime_key, worker_id), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size < SIMTIME_SIZE:
+            os.ftruncate(fd, SIMTIME_SIZE)
+        simtime_map = mmap.mmap(fd, SIMTIME_SIZE)
+    finally:
+        os.close(fd)
+    simulated_time = struct.unpack_from(SIMTIME_FORMAT, simtime_map, 0)[0]
+    print(('resuming with simulated time %d' % simulated_time))
+
+
+def advance_simulated_time(delta):
     global simulated_time
+    if simulated_time == SIMULATED_TIME_UNDEFINED:
+        load_simulated_time()
+    simulated_time += delta
+    struct.pack_into(SIMTIME_FORMAT, simtime_map, 0, simulated_time)
+
+
+def save_simulated_time():
+    if simtime_map is not None:
+        simtime_map.flush()
+
+
+# the file index is traced rather than the values it was computed from,
+# so that a replayed trace accesses the same files whatever the state of
+# the simulated time or the latest-created file
+
+
+def gen_random_fn(is_create=False):
+    index = random_pool.traced(file_index_source, gen_random_index, is_create)
+    if verbosity & 0x20:
+        print('next file index %u out of %u' % (index, max_files_per_dir()))
+    fn = gen_file_path(index)
+    if verbosity & 0x20:
+        print('next pathname %s' % fn)
+    return fn
+
+
+def gen_random_index(is_create):
     global last_center
-    if total_dirs == 1:  # if first time
-        for i in range(0, opts.levels):
-            total_dirs *= opts.dirs_per_level
-    max_files_per_dir = opts.max_files // total_dirs
 
     if opts.rand_distr_type == file_access_dist.UNIFORM:
         # lower limit 0 means at least 1 file/dir
-        index = random.randint(0, max_files_per_dir)
+        index = uniform_index_pool.next()
     elif opts.rand_distr_type == file_access_dist.GAUSSIAN:
 
         # if simulated time is not defined,
         # attempt to read it in from a file, set to zero if no file
 
         if simulated_time == SIMULATED_TIME_UNDEFINED:
-            try:
-                with open(simtime_pathname, 'r') as readtime_fd:
-                    simulated_time = int(readtime_fd.readline().strip())
-            except IOError as e:
-                if e.errno != errno.ENOENT:
-                    raise e
-                simulated_time = 0
-            print(('resuming with simulated time %d' % simulated_time))
+            load_simulated_time()
 
         # for creates, use greater time, so that reads, etc. will "follow" creates most of the time
         # mean and std deviation define gaussian distribution
@@ -138,8 +544,7 @@ def gen_random_fn(is_create=False):
             center += (opts.create_stddevs_ahead * opts.gaussian_stddev)
         if verbosity & 0x20:
             print('%f = center' % center)
-        index_float = numpy.random.normal(
-            loc=center, scale=opts.gaussian_stddev)
+        index_float = center + (opts.gaussian_stddev * gaussian_pool.next())
         file_opstr = 'read'
         if is_create:
             file_opstr = 'create'
@@ -153,28 +558,44 @@ def gen_random_fn(is_create=False):
         # so we can pick up where we left off
 
         if opts.drift_time == -1:
-            simulated_time += 1
-        if simulated_time % time_save_rate == 0:
-            with open(simtime_pathname, 'w') as time_fd:
-                time_fd.write('%10d' % simulated_time)
+            advance_simulated_time(1)
 
+    elif opts.rand_distr_type == file_access_dist.ZIPF:
+        index = zipf_pool.next()
+    elif opts.rand_distr_type == file_access_dist.HOTSPOT:
+        index = hotspot_pool.next()
+    elif opts.rand_distr_type == file_access_dist.LATEST:
+        if is_create:
+            index = next_latest_create()
+        else:
+            index = (latest_index - zipf_pool.next()) % opts.max_files
     else:
         index = 'invalid-distribution-type'  # should never happen
-    if verbosity & 0x20:
-        print('next file index %u out of %u' % (index, max_files_per_dir))
-    dirpath = gen_random_dirname(index)
-    fn = os.path.join(dirpath, 'f%09d' % index)
-    if verbosity & 0x20:
-        print('next pathname %s' % fn)
-    return fn
+    return index
+
+
+file_index_source = random_pool.trace_source(gen_random_index)
 
 
 def random_file_size():
-    return random.randint(1, opts.max_file_size_kb * BYTES_PER_KB)
+    if direct_io:
+        return direct_align(file_size_pool.next())
+    return file_size_pool.next()
+
+
+# an operation can use thousands of record sizes, so while a trace is
+# recorded or replayed they come from a stream that the tracer starts from
+# one traced seed per operation (see optrace.py) instead of from the pool
 
 
 def random_record_size():
-    return random.randint(1, opts.max_record_size_kb * BYTES_PER_KB)
+    tracer = random_pool.current_tracer()
+    if tracer is not None:
+        return 1 + int(tracer.stream_fraction(record_size_source) * opts.max_record_size_kb * BYTES_PER_KB)
+    return record_size_pool.next()
+
+
+record_size_source = random_pool.trace_source(random_record_size)
 
 
 def random_segment_size(filesz):
@@ -184,11 +605,23 @@ def random_segment_size(filesz):
         segsize = 2*random_record_size()
     if segsize > filesz:
         segsize = filesz//7
+    if direct_io:
+        return direct_align(segsize)
     return segsize
 
 
+# random integer from 1 to n
+
+
+def random_count(n):
+    return min(1 + int(fraction_pool.next() * n), n)
+
+
 def random_seek_offset(filesz):
-    return random.randint(0, filesz)
+    off = int(fraction_pool.next() * (filesz + 1))
+    if direct_io:
+        return off - (off % DIRECT_ALIGN)
+    return off
 
 
 def try_to_close(closefd, filename):
@@ -202,92 +635,91 @@ def try_to_close(closefd, filename):
 
 def get_recsz():
     if opts.fix_record_size_kb:
-        return opts.fix_record_size_kb * BYTES_PER_KB
+        recsz = opts.fix_record_size_kb * BYTES_PER_KB
     else:
-        return random_record_size()
+        recsz = random_record_size()
+    if direct_io:
+        return direct_align(recsz)
+    return recsz
 
 def read():
-    global e_file_not_found, have_read, read_requests, read_bytes
-    global time_before, time_after
+    c = counters()
     s = OK
     fd = FD_UNDEFINED
     fn = gen_random_fn()
     try:
-        fd = os.open(fn, os.O_RDONLY)
+        c.time_before = time.time()
+        fd = os.open(fn, data_open_flags(os.O_RDONLY))
         stinfo = os.fstat(fd)
         if verbosity & 0x4000:
             print('read file %s sz %u' % (fn, stinfo.st_size))
         total_read = 0
-        time_before = time.time()
+        c.open_done = time.time()
         while total_read < stinfo.st_size:
             rdsz = get_recsz()
-            bytes = os.read(fd, rdsz)
-            count = len(bytes)
-            read_requests += 1
-            read_bytes += count
+            count = read_record(fd, rdsz)
+            if count == 0:
+                break  # file was truncated by another thread
+            c.read_requests += 1
+            c.read_bytes += count
             if verbosity & 0x4000:
                 print('seq. read off %u sz %u got %u' %\
                     (total_read, rdsz, count))
-            total_read += len(bytes)
-        time_after = time.time()
-        have_read += 1
+            total_read += count
+        c.io_done = time.time()
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        c.have_read += 1
     except os.error as e:
         if e.errno == errno.ENOENT:
-            e_file_not_found += 1
+            c.e_file_not_found += 1
         else:
-            scallerr('close', filename, e)
+            scallerr('read', fn, e)
             s = NOTOK
     try_to_close(fd, fn)
     return s
 
 
 def random_read():
-    global e_file_not_found, have_randomly_read, randread_requests, randread_bytes
-    global time_before, time_after
+    c = counters()
     s = OK
     fd = FD_UNDEFINED
-    have_randomly_read += 1
     fn = gen_random_fn()
     try:
-        fd = os.open(fn, os.O_RDONLY)
+        c.time_before = time.time()
+        fd = os.open(fn, data_open_flags(os.O_RDONLY))
         stinfo = os.fstat(fd)
         total_read_reqs = 0
-        target_read_reqs = random.randint(1, opts.max_random_reads)
+        target_read_reqs = random_count(opts.max_random_reads)
         if verbosity & 0x2000:
             print('randread %s filesize %u reqs %u' % (
                 fn, stinfo.st_size, target_read_reqs))
-        time_before = time.time()
+        c.open_done = time.time()
         while total_read_reqs < target_read_reqs:
-            off = os.lseek(fd, random_seek_offset(stinfo.st_size), 0)
-            if verbosity & 0x2000:
-                print('randread off %u sz %u' % (off, rdsz))            
-            total_count = 0
-            remaining_sz = stinfo.st_size - off
+            off = random_seek_offset(stinfo.st_size)
             targetsz = random_segment_size(stinfo.st_size)
             if opts.singleIO:
                 targetsz = get_recsz()
-            while total_count < targetsz:
-                recsz = get_recsz()
-                if recsz + total_count > remaining_sz:
-                    recsz = remaining_sz - total_count
-                elif recsz + total_count > targetsz:
-                    recsz = targetsz - total_count
-                if recsz == 0:
-                    break
-                bytebuf = os.read(fd, recsz)
-                count = len(bytebuf)
-                assert count > 0
-                if verbosity & 0x2000:
-                    print('randread recsz %u count %u' % (recsz, count))
-                total_count += count
-                randread_bytes += count
+            targetsz = min(targetsz, stinfo.st_size - off)
+            if direct_io:
+                targetsz = direct_align(targetsz)
+            if verbosity & 0x2000:
+                print('randread off %u sz %u' % (off, targetsz))
+            total_count = pread_segment(fd, off, record_sizes(targetsz))
+            if verbosity & 0x2000:
+                print('randread count %u' % total_count)
+            c.randread_bytes += total_count
             total_read_reqs += 1
-            randread_requests += 1
-        time_after = time.time()
-        have_randomly_read += 1
+            c.randread_requests += 1
+        c.io_done = time.time()
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        c.have_randomly_read += 1
     except os.error as e:
         if e.errno == errno.ENOENT:
-            e_file_not_found += 1
+            c.e_file_not_found += 1
         else:
             scallerr('random_read', fn, e)
             s = NOTOK
@@ -295,66 +727,86 @@ def random_read():
     return s
 
 
-def maybe_fsync(fd):
-    global fsyncs, fdatasyncs
-    percent = random.randint(0, 100)
+# if the data was written through a mapping, msync it instead
+
+
+def maybe_fsync(fd, mapping=None):
+    c = counters()
+    percent = percent_pool.next()
     if percent > opts.fsync_probability_pct + opts.fdatasync_probability_pct:
         return
     if percent > opts.fsync_probability_pct:
-        fdatasyncs += 1
-        os.fdatasync(fd)
+        c.fdatasyncs += 1
+        if mapping is not None:
+            mapping.flush()
+        else:
+            os.fdatasync(fd)
     else:
-        fsyncs += 1
-        os.fsync(fd)
+        c.fsyncs += 1
+        if mapping is not None:
+            mapping.flush()
+        else:
+            os.fsync(fd)
 
 
 def create():
-    global have_created, e_already_exists, write_requests, write_bytes, dirs_created
-    global e_no_dir_space, e_no_inode_space, e_no_space
-    global time_before, time_after
+    c = counters()
     s = OK
     fd = FD_UNDEFINED
     fn = gen_random_fn(is_create=True)
     target_sz = random_file_size()
-    refresh_buf(target_sz)
     if verbosity & 0x1000:
         print('create %s sz %s' % (fn, target_sz))
     subdir = os.path.dirname(fn)
-    if not os.path.isdir(subdir):
-        try:
-            os.makedirs(subdir)
-        except OSError as e:
-            if e.errno == errno.ENOSPC:
-                e_no_dir_space += 1
-                return OK
-            scallerr('create', fn, e)
-            return NOTOK
-        dirs_created += 1
+    if subdir not in known_dirs:
+        if not os.path.isdir(subdir):
+            try:
+                os.makedirs(subdir)
+                c.dirs_created += 1
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    c.e_no_dir_space += 1
+                    return OK
+                # another worker may have just created it
+                if e.errno != errno.EEXIST:
+                    scallerr('create', fn, e)
+                    return NOTOK
+        known_dirs.add(subdir)
     try:
-        fd = os.open(fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        c.time_before = time.time()
+        fd = os.open(fn, data_open_flags(os.O_CREAT | os.O_EXCL | os.O_WRONLY))
         total_sz = 0
         offset = 0
-        time_before = time.time()
+        base = random_buf_base()
+        c.open_done = time.time()
         while total_sz < target_sz:
             recsz = get_recsz()
             if recsz + total_sz > target_sz:
                 recsz = target_sz - total_sz
-            count = os.write(fd, buf[offset:offset+recsz])
+            count = os.write(fd, buf_slice(base + offset, recsz))
             offset += count
             assert count > 0
             if verbosity & 0x1000:
                 print('create sz %u written %u' % (recsz, count))
             total_sz += count
-            write_requests += 1
-            write_bytes += count
+            c.write_requests += 1
+            c.write_bytes += count
+        c.io_done = time.time()
         maybe_fsync(fd)
-        time_after = time.time()
-        have_created += 1
+        c.sync_done = time.time()
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        c.have_created += 1
     except os.error as e:
         if e.errno == errno.EEXIST:
-            e_already_exists += 1
+            c.e_already_exists += 1
         elif e.errno == errno.ENOSPC:
-            e_no_inode_space += 1
+            c.e_no_inode_space += 1
+        elif e.errno == errno.ENOENT:
+            # directory was removed behind our back, look it up again next time
+            known_dirs.discard(subdir)
+            c.e_file_not_found += 1
         else:
             scallerr('create', fn, e)
             s = NOTOK
@@ -362,23 +814,55 @@ def create():
     return s
 
 
+# create one file with the given index before the test starts, with the
+# size distribution used by create() but written in the largest records the
+# write buffer allows.  files that already exist are skipped.  unlike
+# create(), errors (including running out of space) are raised to the caller
+
+
+def prefill_file(file_index):
+    c = counters()
+    fn = gen_file_path(file_index)
+    subdir = os.path.dirname(fn)
+    if subdir not in known_dirs:
+        os.makedirs(subdir, exist_ok=True)
+        known_dirs.add(subdir)
+    target_sz = random_file_size()
+    try:
+        fd = os.open(fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            c.e_already_exists += 1
+            return
+        raise e
+    try:
+        total_sz = 0
+        base = random_buf_base()
+        while total_sz < target_sz:
+            count = os.write(fd, buf_slice(base + total_sz, min(buf_ring, target_sz - total_sz)))
+            total_sz += count
+            c.write_requests += 1
+            c.write_bytes += count
+        c.have_created += 1
+    finally:
+        os.close(fd)
+
+
 def append():
-    global have_appended, write_requests, write_bytes, e_file_not_found
-    global e_no_space
-    global time_before, time_after
+    c = counters()
     s = OK
     fn = gen_random_fn()
     target_sz = random_file_size()
-    refresh_buf(target_sz)
     if verbosity & 0x8000:
         print('append %s sz %s' % (fn, target_sz))
     fd = FD_UNDEFINED
     try:
-        fd = os.open(fn, os.O_WRONLY)
-        have_appended += 1
+        c.time_before = time.time()
+        fd = os.open(fn, data_open_flags(os.O_WRONLY))
         total_appended = 0
         offset = 0
-        time_before = time.time()
+        base = random_buf_base()
+        c.open_done = time.time()
         while total_appended < target_sz:
             recsz = get_recsz()
             if recsz + total_appended > target_sz:
@@ -386,21 +870,25 @@ def append():
             assert recsz > 0
             if verbosity & 0x8000:
                 print('append rsz %u' % (recsz))
-            count = os.write(fd, buf[offset:offset+recsz])
+            count = os.write(fd, buf_slice(base + offset, recsz))
             offset += count
 
             assert count > 0
             total_appended += count
-            write_requests += 1
-            write_bytes += count
+            c.write_requests += 1
+            c.write_bytes += count
+        c.io_done = time.time()
         maybe_fsync(fd)
-        time_after = time.time()
-        have_appended += 1
+        c.sync_done = time.time()
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        c.have_appended += 1
     except os.error as e:
         if e.errno == errno.ENOENT:
-            e_file_not_found += 1
+            c.e_file_not_found += 1
         elif e.errno == errno.ENOSPC:
-            e_no_space += 1
+            c.e_no_space += 1
         else:
             scallerr('append', fn, e)
             s = NOTOK
@@ -409,48 +897,44 @@ def append():
 
 
 def random_write():
-    global have_randomly_written, randwrite_requests, randwrite_bytes, e_file_not_found
-    global e_no_space
-    global time_before, time_after
+    c = counters()
     s = OK
     fd = FD_UNDEFINED
     fn = gen_random_fn()
     try:
-        fd = os.open(fn, os.O_WRONLY)
+        c.time_before = time.time()
+        fd = os.open(fn, data_open_flags(os.O_WRONLY))
         stinfo = os.fstat(fd)
         total_write_reqs = 0
-        target_write_reqs = random.randint(1, opts.max_random_writes)
+        target_write_reqs = random_count(opts.max_random_writes)
         if verbosity & 0x20000:
             print('randwrite %s reqs %u' % (fn, target_write_reqs))
-        time_before = time.time()
+        c.open_done = time.time()
         while total_write_reqs < target_write_reqs:
-            off = os.lseek(fd, random_seek_offset(stinfo.st_size), 0)
-            total_count = 0
+            off = random_seek_offset(stinfo.st_size)
             targetsz = random_segment_size(stinfo.st_size)
             if opts.singleIO:
                 targetsz = get_recsz() 
             if verbosity & 0x20000:
                 print('randwrite off %u sz %u' % (off, targetsz))
-            while total_count < targetsz:
-                recsz = get_recsz()
-                if recsz + total_count > targetsz:
-                    recsz = targetsz - total_count
-                count = os.write(fd, buf[0:recsz])
-                if verbosity & 0x20000:
-                    print('randwrite count=%u recsz=%u' % (count, recsz))
-                assert count > 0
-                total_count += count
+            total_count = pwrite_segment(fd, off, record_sizes(targetsz), random_buf_base())
+            if verbosity & 0x20000:
+                print('randwrite count=%u' % total_count)
             total_write_reqs += 1
-            randwrite_requests += 1
-            randwrite_bytes += total_count
+            c.randwrite_requests += 1
+            c.randwrite_bytes += total_count
+        c.io_done = time.time()
         maybe_fsync(fd)
-        time_after = time.time()
-        have_randomly_written += 1
+        c.sync_done = time.time()
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        c.have_randomly_written += 1
     except os.error as e:
         if e.errno == errno.ENOENT:
-            e_file_not_found += 1
+            c.e_file_not_found += 1
         elif e.errno == errno.ENOSPC:
-            e_no_space += 1
+            c.e_no_space += 1
         else:
             scallerr('random write', fn, e)
             s = NOTOK
@@ -459,23 +943,31 @@ def random_write():
 
 
 def truncate():
-    global have_truncated, e_file_not_found
-    global time_before, time_after
+    c = counters()
     fd = FD_UNDEFINED
     s = OK
     fn = gen_random_fn()
     if verbosity & 0x40000:
         print('truncate %s' % fn)
     try:
-        new_file_size = random_file_size()/3
-        time_before = time.time()
+        new_file_size = random_file_size()//3
+        if direct_io:
+            # keep end of file aligned for later O_DIRECT writes
+            new_file_size -= new_file_size % DIRECT_ALIGN
+        c.time_before = time.time()
         fd = os.open(fn, os.O_RDWR)
+        if opts.io_engine == IO_ENGINE_MMAP:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        c.open_done = time.time()
         os.ftruncate(fd, new_file_size)
-        time_after = time.time()
-        have_truncated += 1
+        c.io_done = time.time()
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        c.have_truncated += 1
     except os.error as e:
         if e.errno == errno.ENOENT:
-            e_file_not_found += 1
+            c.e_file_not_found += 1
         else:
             scallerr('truncate', fn, e)
             s = NOTOK
@@ -484,26 +976,25 @@ def truncate():
 
 
 def link():
-    global have_linked, e_file_not_found, e_already_exists
-    global time_before, time_after
+    c = counters()
     fn = gen_random_fn()
     fn2 = gen_random_fn() + link_suffix
     if verbosity & 0x10000:
         print('link to %s from %s' % (fn, fn2))
     if not os.path.isfile(fn):
-        e_file_not_found += 1
+        c.e_file_not_found += 1
         return OK
     try:
-        time_before = time.time()
+        c.time_before = time.time()
         rc = os.symlink(fn, fn2)
-        time_after = time.time()
-        have_linked += 1
+        c.time_after = time.time()
+        c.have_linked += 1
     except os.error as e:
         if e.errno == errno.EEXIST:
-            e_already_exists += 1
+            c.e_already_exists += 1
             return OK
         elif e.errno == errno.ENOENT:
-            e_file_not_found += 1
+            c.e_file_not_found += 1
             return OK
         scallerr('link', fn, e)
         return NOTOK
@@ -511,26 +1002,25 @@ def link():
 
 
 def hlink():
-    global have_hlinked, e_file_not_found, e_already_exists
-    global time_before, time_after
+    c = counters()
     fn = gen_random_fn()
     fn2 = gen_random_fn() + hlink_suffix
     if verbosity & 0x10000:
         print('hard link to %s from %s' % (fn, fn2))
     if not os.path.isfile(fn):
-        e_file_not_found += 1
+        c.e_file_not_found += 1
         return OK
     try:
-        time_before = time.time()
+        c.time_before = time.time()
         rc = os.link(fn, fn2)
-        time_after = time.time()
-        have_hlinked += 1
+        c.time_after = time.time()
+        c.have_hlinked += 1
     except os.error as e:
         if e.errno == errno.EEXIST:
-            e_already_exists += 1
+            c.e_already_exists += 1
             return OK
         elif e.errno == errno.ENOENT:
-            e_file_not_found += 1
+            c.e_file_not_found += 1
             return OK
         scallerr('link', fn, e)
         return NOTOK
@@ -538,14 +1028,13 @@ def hlink():
 
 
 def delete():
-    global have_deleted, e_file_not_found
-    global time_before, time_after
+    c = counters()
     fn = gen_random_fn()
     if verbosity & 0x20000:
         print('delete %s' % (fn))
     try:
         linkfn = fn + link_suffix
-        time_before = time.time()
+        c.time_before = time.time()
         if os.path.isfile(linkfn):
             if verbosity & 0x20000:
                 print('delete soft link %s' % (linkfn))
@@ -556,11 +1045,11 @@ def delete():
                 print('delete hard link %s' % (hlinkfn))
             os.unlink(hlinkfn)
         os.unlink(fn)
-        time_after = time.time()
-        have_deleted += 1
+        c.time_after = time.time()
+        c.have_deleted += 1
     except os.error as e:
         if e.errno == errno.ENOENT:
-            e_file_not_found += 1
+            c.e_file_not_found += 1
             return OK
         scallerr('delete', fn, e)
         return NOTOK
@@ -568,26 +1057,536 @@ def delete():
 
 
 def rename():
-    global have_renamed, e_file_not_found
-    global time_before, time_after
+    c = counters()
     fn = gen_random_fn()
     fn2 = gen_random_fn()
     if verbosity & 0x20000:
         print('rename %s to %s' % (fn, fn2))
     try:
-        time_before = time.time()
+        c.time_before = time.time()
         os.rename(fn, fn2)
-        time_after = time.time()
-        have_renamed += 1
+        c.time_after = time.time()
+        c.have_renamed += 1
     except os.error as e:
         if e.errno == errno.ENOENT:
-            e_file_not_found += 1
+            c.e_file_not_found += 1
             return OK
         scallerr('rename', fn, e)
         return NOTOK
     return OK
 
 
+# copy and clone create a new file from an existing one, like cp would.
+# copy asks the kernel to copy the data with copy_file_range(), which
+# filesystems such as XFS, Btrfs and NFS 4.2 can do without moving the data
+# through the client, and falls back to sendfile() where it isn't supported.
+# clone shares the data blocks with the FICLONE ioctl (a reflink), and falls
+# back to copying where the filesystem can't do that.
+
+FICLONE = getattr(fcntl, 'FICLONE', 0x40049409)
+copy_fallback_errnos = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL)
+clone_fallback_errnos = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL)
+
+
+def copy_data(c, fd, fd2, filesz):
+    total = 0
+    use_sendfile = False
+    while total < filesz:
+        if not use_sendfile:
+            try:
+                count = os.copy_file_range(fd, fd2, filesz - total, total, total)
+            except OSError as e:
+                if e.errno not in copy_fallback_errnos:
+                    raise e
+                c.copy_fallbacks += 1
+                use_sendfile = True
+                os.lseek(fd2, total, 0)
+                continue
+        else:
+            count = os.sendfile(fd2, fd, total, filesz - total)
+        if count == 0:
+            break  # file was truncated by another thread
+        total += count
+    return total
+
+
+def copy_or_clone(clone_it):
+    c = counters()
+    s = OK
+    fd = FD_UNDEFINED
+    fd2 = FD_UNDEFINED
+    fn = gen_random_fn()
+    fn2 = gen_random_fn(is_create=True)
+    if verbosity & 0x10000:
+        print('%s %s to %s' % ('clone' if clone_it else 'copy', fn, fn2))
+    try:
+        c.time_before = time.time()
+        fd = os.open(fn, os.O_RDONLY)
+        filesz = os.fstat(fd).st_size
+        fd2 = os.open(fn2, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        c.open_done = time.time()
+        if clone_it:
+            try:
+                fcntl.ioctl(fd2, FICLONE, fd)
+                count = filesz
+            except OSError as e:
+                if e.errno not in clone_fallback_errnos:
+                    raise e
+                c.clone_fallbacks += 1
+                count = copy_data(c, fd, fd2, filesz)
+            c.clone_bytes += count
+        else:
+            c.copy_bytes += copy_data(c, fd, fd2, filesz)
+        c.io_done = time.time()
+        maybe_fsync(fd2)
+        c.sync_done = time.time()
+        os.close(fd2)
+        fd2 = FD_UNDEFINED
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        if clone_it:
+            c.have_cloned += 1
+        else:
+            c.have_copied += 1
+    except os.error as e:
+        if e.errno == errno.ENOENT:
+            c.e_file_not_found += 1
+        elif e.errno == errno.EEXIST:
+            c.e_already_exists += 1
+        elif e.errno == errno.ENOSPC:
+            c.e_no_space += 1
+        else:
+            scallerr('clone' if clone_it else 'copy', fn, e)
+            s = NOTOK
+    try_to_close(fd, fn)
+    try_to_close(fd2, fn2)
+    return s
+
+
+def copy():
+    return copy_or_clone(False)
+
+
+def clone():
+    return copy_or_clone(True)
+
+# metadata operations, which don't touch file data.  lstat looks at the
+# symbolic link made by the link operation, readdir lists the directory that
+# a file would be in, and the xattr operations use one user attribute with
+# a value of up to xattr_max_size bytes.
+
+
+xattr_name = 'user.fs-drift'
+xattr_max_size = 256
+
+
+def metadata_error(c, opname, fn, e):
+    if e.errno == errno.ENOENT:
+        c.e_file_not_found += 1
+        return OK
+    if e.errno == errno.ENODATA:
+        c.e_no_xattr += 1
+        return OK
+    if e.errno == errno.EOPNOTSUPP:
+        c.e_not_supported += 1
+        return OK
+    scallerr(opname, fn, e)
+    return NOTOK
+
+
+def stat():
+    c = counters()
+    fn = gen_random_fn()
+    try:
+        c.time_before = time.time()
+        os.stat(fn)
+        c.time_after = time.time()
+        c.have_statted += 1
+    except os.error as e:
+        return metadata_error(c, 'stat', fn, e)
+    return OK
+
+
+def lstat():
+    c = counters()
+    fn = gen_random_fn() + link_suffix
+    try:
+        c.time_before = time.time()
+        os.lstat(fn)
+        c.time_after = time.time()
+        c.have_lstatted += 1
+    except os.error as e:
+        return metadata_error(c, 'lstat', fn, e)
+    return OK
+
+
+def readdir():
+    c = counters()
+    dn = os.path.dirname(gen_random_fn())
+    if verbosity & 0x10000:
+        print('readdir %s' % dn)
+    try:
+        c.time_before = time.time()
+        with os.scandir(dn) as it:
+            entries = sum(1 for entry in it)
+        c.time_after = time.time()
+        c.have_listed_dirs += 1
+        c.dir_entries += entries
+    except os.error as e:
+        return metadata_error(c, 'readdir', dn, e)
+    return OK
+
+
+def getxattr():
+    c = counters()
+    fn = gen_random_fn()
+    try:
+        c.time_before = time.time()
+        os.getxattr(fn, xattr_name)
+        c.time_after = time.time()
+        c.have_getxattrs += 1
+    except os.error as e:
+        return metadata_error(c, 'getxattr', fn, e)
+    return OK
+
+
+def setxattr():
+    c = counters()
+    fn = gen_random_fn()
+    value = buf_slice(random_buf_base(), 1 + (file_size_pool.next() % xattr_max_size))
+    try:
+        c.time_before = time.time()
+        os.setxattr(fn, xattr_name, value)
+        c.time_after = time.time()
+        c.have_setxattrs += 1
+    except os.error as e:
+        if e.errno == errno.ENOSPC:
+            c.e_no_space += 1
+            return OK
+        return metadata_error(c, 'setxattr', fn, e)
+    return OK
+
+
+def chmod():
+    c = counters()
+    fn = gen_random_fn()
+    mode = (0o644, 0o664)[random_count(2) - 1]
+    try:
+        c.time_before = time.time()
+        os.chmod(fn, mode)
+        c.time_after = time.time()
+        c.have_chmodded += 1
+    except os.error as e:
+        return metadata_error(c, 'chmod', fn, e)
+    return OK
+
+
+def utime():
+    c = counters()
+    fn = gen_random_fn()
+    try:
+        c.time_before = time.time()
+        os.utime(fn)
+        c.time_after = time.time()
+        c.have_utimed += 1
+    except os.error as e:
+        return metadata_error(c, 'utime', fn, e)
+    return OK
+
+# space management operations.  preallocate allocates a random range of a
+# file with posix_fallocate(), which can extend it.  punch_hole deallocates a
+# range, leaving a sparse file, and zero_range turns a range into unwritten
+# extents.  neither changes the file size.  python has no wrapper for
+# fallocate() with flags, so it is called through ctypes.
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+FALLOC_FL_ZERO_RANGE = 0x10
+
+libc = ctypes.CDLL(None, use_errno=True)
+libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+
+def fallocate(fd, mode, offset, length):
+    if libc.fallocate(fd, mode, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def space_error(c, opname, fn, e):
+    if e.errno == errno.ENOSPC:
+        c.e_no_space += 1
+        return OK
+    return metadata_error(c, opname, fn, e)
+
+
+def preallocate():
+    c = counters()
+    s = OK
+    fd = FD_UNDEFINED
+    fn = gen_random_fn()
+    try:
+        c.time_before = time.time()
+        fd = os.open(fn, os.O_WRONLY)
+        off = random_seek_offset(os.fstat(fd).st_size)
+        length = random_file_size()
+        if verbosity & 0x40000:
+            print('preallocate %s off %u sz %u' % (fn, off, length))
+        c.open_done = time.time()
+        if length > 0:
+            os.posix_fallocate(fd, off, length)
+        c.io_done = time.time()
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        c.have_preallocated += 1
+        c.prealloc_bytes += length
+    except os.error as e:
+        s = space_error(c, 'preallocate', fn, e)
+    try_to_close(fd, fn)
+    return s
+
+
+def deallocate(zero_it):
+    c = counters()
+    s = OK
+    fd = FD_UNDEFINED
+    fn = gen_random_fn()
+    opname = 'zero_range' if zero_it else 'punch_hole'
+    try:
+        c.time_before = time.time()
+        fd = os.open(fn, os.O_WRONLY)
+        filesz = os.fstat(fd).st_size
+        off = random_seek_offset(filesz)
+        length = min(random_segment_size(filesz), filesz - off)
+        if verbosity & 0x40000:
+            print('%s %s off %u sz %u' % (opname, fn, off, length))
+        c.open_done = time.time()
+        if length > 0:
+            if zero_it:
+                fallocate(fd, FALLOC_FL_ZERO_RANGE | FALLOC_FL_KEEP_SIZE, off, length)
+            else:
+                fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, off, length)
+        c.io_done = time.time()
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        if zero_it:
+            c.have_zeroed += 1
+            c.zero_bytes += length
+        else:
+            c.have_punched += 1
+            c.punch_bytes += length
+    except os.error as e:
+        s = space_error(c, opname, fn, e)
+    try_to_close(fd, fn)
+    return s
+
+
+def punch_hole():
+    return deallocate(False)
+
+
+def zero_range():
+    return deallocate(True)
+
+# the mmap I/O engine.  touching a mapped page past the end of file kills
+# the process with SIGBUS, so a file must not shrink while another thread or
+# worker has it mapped: these operations hold a shared flock on the file while
+# it is mapped, and operations that change its size (append and truncate)
+# hold an exclusive one.  data is copied between the mapping and the
+# read or write buffer in records of the usual size.
+
+
+def open_mapped(fn, flags, lock):
+    fd = os.open(fn, flags)
+    try:
+        fcntl.flock(fd, lock)
+    except OSError as e:
+        os.close(fd)
+        raise e
+    return fd
+
+
+def mmap_read():
+    c = counters()
+    s = OK
+    fd = FD_UNDEFINED
+    fn = gen_random_fn()
+    try:
+        c.time_before = time.time()
+        fd = open_mapped(fn, os.O_RDONLY, fcntl.LOCK_SH)
+        filesz = os.fstat(fd).st_size
+        if verbosity & 0x4000:
+            print('mmap read file %s sz %u' % (fn, filesz))
+        c.open_done = time.time()
+        if filesz > 0:
+            with mmap.mmap(fd, filesz, prot=mmap.PROT_READ) as m, memoryview(m) as mv:
+                total_read = 0
+                while total_read < filesz:
+                    count = min(get_recsz(), filesz - total_read)
+                    read_view[0:count] = mv[total_read:total_read + count]
+                    total_read += count
+                    c.read_requests += 1
+                    c.read_bytes += count
+        c.io_done = time.time()
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        c.have_read += 1
+    except os.error as e:
+        if e.errno == errno.ENOENT:
+            c.e_file_not_found += 1
+        else:
+            scallerr('mmap read', fn, e)
+            s = NOTOK
+    try_to_close(fd, fn)
+    return s
+
+
+def mmap_random_read():
+    c = counters()
+    s = OK
+    fd = FD_UNDEFINED
+    fn = gen_random_fn()
+    try:
+        c.time_before = time.time()
+        fd = open_mapped(fn, os.O_RDONLY, fcntl.LOCK_SH)
+        filesz = os.fstat(fd).st_size
+        target_read_reqs = random_count(opts.max_random_reads)
+        if verbosity & 0x2000:
+            print('mmap randread %s filesize %u reqs %u' % (
+                fn, filesz, target_read_reqs))
+        c.open_done = time.time()
+        if filesz > 0:
+            with mmap.mmap(fd, filesz, prot=mmap.PROT_READ) as m, memoryview(m) as mv:
+                for k in range(0, target_read_reqs):
+                    off = min(random_seek_offset(filesz), filesz)
+                    targetsz = random_segment_size(filesz)
+                    if opts.singleIO:
+                        targetsz = get_recsz()
+                    targetsz = min(targetsz, filesz - off)
+                    total_count = 0
+                    while total_count < targetsz:
+                        count = min(get_recsz(), targetsz - total_count)
+                        start = off + total_count
+                        read_view[0:count] = mv[start:start + count]
+                        total_count += count
+                    c.randread_bytes += total_count
+                    c.randread_requests += 1
+        c.io_done = time.time()
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        c.have_randomly_read += 1
+    except os.error as e:
+        if e.errno == errno.ENOENT:
+            c.e_file_not_found += 1
+        else:
+            scallerr('mmap random_read', fn, e)
+            s = NOTOK
+    try_to_close(fd, fn)
+    return s
+
+
+def mmap_random_write():
+    c = counters()
+    s = OK
+    fd = FD_UNDEFINED
+    fn = gen_random_fn()
+    try:
+        c.time_before = time.time()
+        fd = open_mapped(fn, os.O_RDWR, fcntl.LOCK_SH)
+        filesz = os.fstat(fd).st_size
+        target_write_reqs = random_count(opts.max_random_writes)
+        if verbosity & 0x20000:
+            print('mmap randwrite %s reqs %u' % (fn, target_write_reqs))
+        c.open_done = time.time()
+        if filesz > 0:
+            with mmap.mmap(fd, filesz) as m, memoryview(m) as mv:
+                for k in range(0, target_write_reqs):
+                    off = min(random_seek_offset(filesz), filesz)
+                    targetsz = random_segment_size(filesz)
+                    if opts.singleIO:
+                        targetsz = get_recsz()
+                    targetsz = min(targetsz, filesz - off)
+                    base = random_buf_base()
+                    total_count = 0
+                    while total_count < targetsz:
+                        count = min(get_recsz(), targetsz - total_count)
+                        start = off + total_count
+                        mv[start:start + count] = buf_slice(base + start, count)
+                        total_count += count
+                    c.randwrite_requests += 1
+                    c.randwrite_bytes += total_count
+                c.io_done = time.time()
+                maybe_fsync(fd, m)
+                c.sync_done = time.time()
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        c.have_randomly_written += 1
+    except os.error as e:
+        if e.errno == errno.ENOENT:
+            c.e_file_not_found += 1
+        elif e.errno == errno.ENOSPC:
+            c.e_no_space += 1
+        else:
+            scallerr('mmap random write', fn, e)
+            s = NOTOK
+    try_to_close(fd, fn)
+    return s
+
+# grow the file with ftruncate, then map from the allocation granule holding
+# the old end of file to the new one and fill it in
+
+
+def mmap_append():
+    c = counters()
+    s = OK
+    fd = FD_UNDEFINED
+    fn = gen_random_fn()
+    target_sz = random_file_size()
+    if verbosity & 0x8000:
+        print('mmap append %s sz %s' % (fn, target_sz))
+    try:
+        c.time_before = time.time()
+        fd = open_mapped(fn, os.O_RDWR, fcntl.LOCK_EX)
+        start = os.fstat(fd).st_size
+        c.open_done = time.time()
+        if target_sz > 0:
+            os.ftruncate(fd, start + target_sz)
+            map_off = start - (start % mmap.ALLOCATIONGRANULARITY)
+            with mmap.mmap(fd, start + target_sz - map_off, offset=map_off) as m, memoryview(m) as mv:
+                total_appended = 0
+                base = random_buf_base()
+                while total_appended < target_sz:
+                    count = min(get_recsz(), target_sz - total_appended)
+                    pos = start - map_off + total_appended
+                    mv[pos:pos + count] = buf_slice(base + start + total_appended, count)
+                    total_appended += count
+                    c.write_requests += 1
+                    c.write_bytes += count
+                c.io_done = time.time()
+                maybe_fsync(fd, m)
+                c.sync_done = time.time()
+        os.close(fd)
+        fd = FD_UNDEFINED
+        c.time_after = time.time()
+        c.have_appended += 1
+    except os.error as e:
+        if e.errno == errno.ENOENT:
+            c.e_file_not_found += 1
+        elif e.errno == errno.ENOSPC:
+            c.e_no_space += 1
+        else:
+            scallerr('mmap append', fn, e)
+            s = NOTOK
+    try_to_close(fd, fn)
+    return s
+
+
 rq_map = \
     {rq.READ: (read, "read"),
      rq.RANDOM_READ: (random_read, "random_read"),
@@ -598,9 +1597,35 @@ rq_map = \
      rq.DELETE: (delete, "delete"),
      rq.RENAME: (rename, "rename"),
      rq.TRUNCATE: (truncate, "truncate"),
-     rq.HARDLINK: (hlink, "hardlink")
+     rq.HARDLINK: (hlink, "hardlink"),
+     rq.COPY: (copy, "copy"),
+     rq.CLONE: (clone, "clone"),
+     rq.STAT: (stat, "stat"),
+     rq.LSTAT: (lstat, "lstat"),
+     rq.READDIR: (readdir, "readdir"),
+     rq.GETXATTR: (getxattr, "getxattr"),
+     rq.SETXATTR: (setxattr, "setxattr"),
+     rq.CHMOD: (chmod, "chmod"),
+     rq.UTIME: (utime, "utime"),
+     rq.PREALLOCATE: (preallocate, "preallocate"),
+     rq.PUNCH_HOLE: (punch_hole, "punch_hole"),
+     rq.ZERO_RANGE: (zero_range, "zero_range")
      }
 
+# operations that time their phases, and the phases
+
+phased_op_names = ('read', 'random_read', 'create', 'random_write', 'append', 'truncate',
+                   'copy', 'clone', 'preallocate', 'punch_hole', 'zero_range')
+phase_names = ('open', 'io', 'sync', 'close')
+
+
+def init_io_engine():
+    if opts.io_engine == IO_ENGINE_MMAP:
+        rq_map[rq.READ] = (mmap_read, "read")
+        rq_map[rq.RANDOM_READ] = (mmap_random_read, "random_read")
+        rq_map[rq.RANDOM_WRITE] = (mmap_random_write, "random_write")
+        rq_map[rq.APPEND] = (mmap_append, "append")
+
 
 if __name__ == "__main__":
     opts.parseopts()
@@ -0,0 +1,131 @@
+# histogram.py - log-bucketed (HDR-style) latency histogram
+#
+# latencies are recorded in microseconds into buckets whose width doubles
+# every power of two, with 2^SUB_BUCKET_BITS buckets per power of two,
+# so any recorded value is reported within about 3% of its true value.
+# the whole histogram is one flat array of counts followed by the maximum,
+# so histograms from many workers can be copied into shared memory and
+# merged by adding arrays element by element.
+
+import array
+import numpy
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_SHIFT = 32  # more than an hour in microseconds
+bucket_count = (MAX_SHIFT + 2) * SUB_BUCKETS
+
+# index of maximum value in the flat array, which is also its length - 1
+MAX_INDEX = bucket_count
+hist_len = bucket_count + 1
+
+report_percentiles = (50.0, 90.0, 99.0, 99.9)
+
+
+def bucket_index(usec):
+    shift = usec.bit_length() - SUB_BUCKET_BITS - 1
+    if shift <= 0:
+        return usec
+    if shift > MAX_SHIFT:
+        return bucket_count - 1
+    return (shift * SUB_BUCKETS) + (usec >> shift)
+
+# bucket_index() for a whole numpy array of values at once.  frexp() gives
+# the bit length of values below 2^53 exactly
+
+
+def bucket_indices(usec):
+    usec = numpy.maximum(usec.astype(numpy.int64), 0)
+    shift = numpy.maximum(numpy.frexp(usec.astype(numpy.float64))[1] - SUB_BUCKET_BITS - 1, 0)
+    indices = (shift * SUB_BUCKETS) + (usec >> shift)
+    return numpy.where(shift > MAX_SHIFT, bucket_count - 1, indices)
+
+# highest value in microseconds that maps into this bucket
+
+
+def bucket_value(index):
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = (index // SUB_BUCKETS) - 1
+    return ((index - (shift * SUB_BUCKETS) + 1) << shift) - 1
+
+
+class latency_histogram:
+
+    def __init__(self, values=None):
+        if values is None:
+            self.values = array.array('d', bytes(8 * hist_len))
+        else:
+            self.values = array.array('d', values)
+
+    def record(self, seconds):
+        usec = int(seconds * 1000000)
+        if usec < 0:
+            usec = 0
+        self.values[bucket_index(usec)] += 1
+        if usec > self.values[MAX_INDEX]:
+            self.values[MAX_INDEX] = usec
+
+    def merge(self, other):
+        v = numpy.frombuffer(self.values, dtype=numpy.float64)
+        o = numpy.frombuffer(other.values, dtype=numpy.float64)
+        v[0:bucket_count] += o[0:bucket_count]
+        if o[MAX_INDEX] > v[MAX_INDEX]:
+            v[MAX_INDEX] = o[MAX_INDEX]
+
+    # the samples recorded since an earlier copy of this histogram was taken.
+    # the maximum of those isn't kept, so it is estimated as the top of the
+    # highest bucket they fall in, but no more than the maximum so far
+
+    def delta(self, earlier):
+        v = numpy.frombuffer(self.values, dtype=numpy.float64)
+        o = numpy.frombuffer(earlier.values, dtype=numpy.float64)
+        d = v.copy()
+        d[0:bucket_count] -= o[0:bucket_count]
+        nonzero = numpy.nonzero(d[0:bucket_count])[0]
+        if len(nonzero) > 0:
+            d[MAX_INDEX] = min(bucket_value(int(nonzero[-1])), v[MAX_INDEX])
+        else:
+            d[MAX_INDEX] = 0
+        return latency_histogram(d.tolist())
+
+    def count(self):
+        return int(sum(self.values[0:bucket_count]))
+
+    # latency in seconds below which pct percent of samples fall
+
+    def percentile(self, pct):
+        total = self.count()
+        if total == 0:
+            return 0.0
+        threshold = total * pct / 100.0
+        seen = 0
+        for k in range(0, bucket_count):
+            seen += self.values[k]
+            if seen >= threshold:
+                usec = min(bucket_value(k), self.values[MAX_INDEX])
+                return usec / 1000000.0
+        return self.max()
+
+    def max(self):
+        return self.values[MAX_INDEX] / 1000000.0
+
+
+def print_latency_table(histograms):
+    print('%-18s %9s %9s %9s %9s %9s %9s' % (
+        'latency(ms)', 'count', 'p50', 'p90', 'p99', 'p99.9', 'max'))
+    for (name, h) in histograms:
+        count = h.count()
+        if count == 0:
+            continue
+        pcts = [h.percentile(p) * 1000.0 for p in report_percentiles]
+        print('%-18s %9u %9.3f %9.3f %9.3f %9.3f %9.3f' % (
+            tuple([name, count] + pcts + [h.max() * 1000.0])))
+
+
+if __name__ == '__main__':
+    import random
+    h = latency_histogram()
+    for k in range(0, 100000):
+        h.record(random.expovariate(1000.0))
+    print_latency_table([('exponential', h)])
@@ -0,0 +1,202 @@
+# optrace.py - record the operations that fs-drift issues in a compact binary
+# trace, and replay them
+#
+# every operation thread writes its own trace file, named
+# <prefix>.w<worker>.t<thread>, with one record per operation:  the time it
+# started (seconds since the start of the run), its opcode, and the random
+# values it used, in the order it used them -- file indices, file sizes,
+# offsets, counts and fsync decisions.  the values are taken where the
+# operation draws them (see random_pool.traced()), so the trace format
+# doesn't depend on which values each operation type needs.  record sizes,
+# of which a large file needs thousands, are not traced one by one:  they
+# come from a small generator that each operation starts from one traced
+# seed (see stream_fraction()), so a record is a few dozen bytes whatever
+# the file size.
+#
+# on replay, each thread reads its own trace file and issues the same
+# operations with the same values, without running the random generators.
+# an operation gets each value from those recorded for it from the same
+# source, in order.  if the filesystem behaves differently, an operation
+# may ask for more values than were recorded for it (for example a random
+# write to a file that is longer than when recording).  those are generated
+# as usual and counted, and the next operation starts again from its own
+# record, so the streams can't drift apart.
+#
+# record layout, little-endian:
+#   double  start time
+#   uint8   opcode
+#   uint32  value count n
+#   n bytes, the source of each value (see random_pool.trace_source())
+#   (n+7)/8 bytes, bit k set if value k is an integer
+#   n values, int64 for integers, double otherwise
+
+import struct
+import random
+
+trace_magic = b'fs-drift-trace\n\0'
+trace_version = 2
+header_format = '<16sI'
+header_len = struct.calcsize(header_format)
+record_format = '<dBI'
+record_len = struct.calcsize(record_format)
+
+
+def trace_pathname(prefix, worker_id, thread_index):
+    return '%s.w%d.t%d' % (prefix, worker_id, thread_index)
+
+
+def mask_len(count):
+    return (count + 7) // 8
+
+# a 64-bit linear congruential generator (Knuth's MMIX constants) for the
+# record size stream.  it is restarted for each operation, where creating
+# a numpy or random.Random generator would cost more than the operation
+
+lcg_multiplier = 6364136223846793005
+lcg_increment = 1442695040888963407
+lcg_mask = (1 << 64) - 1
+lcg_scale = float(1 << 53)
+
+
+def gen_seed():
+    return random.getrandbits(63)
+
+
+class tracer:
+
+    stream_state = None
+
+    # a fraction in [0, 1) from this operation's stream, which starts from
+    # a seed drawn (and traced as a value from source) at the first call
+
+    def stream_fraction(self, source):
+        state = self.stream_state
+        if state is None:
+            state = self.value(source, gen_seed)
+        state = (state * lcg_multiplier + lcg_increment) & lcg_mask
+        self.stream_state = state
+        return (state >> 11) / lcg_scale
+
+# most operations of a type use values from the same sources in the same
+# order, so the layout of each such sequence of sources is worked out once
+# and cached, and then a record is packed or unpacked with one struct call
+
+
+class trace_recorder(tracer):
+
+    replaying = False
+
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.f = open(pathname, 'wb')
+        self.f.write(struct.pack(header_format, trace_magic, trace_version))
+        self.layouts = {}
+        self.sources = None
+        self.values = None
+        self.ops = 0
+
+    def begin_op(self, t, opcode):
+        self.t = t
+        self.opcode = opcode
+        self.stream_state = None
+        self.sources = bytearray()
+        self.values = []
+
+    def value(self, source, gen, *args):
+        v = gen(*args)
+        if self.values is not None:
+            self.sources.append(source)
+            self.values.append(v)
+        return v
+
+    # the layout is the struct for the record after its source bytes, and
+    # the integer mask, which is the same for every record with the same
+    # sources because a source always returns the same type
+
+    def layout(self, sources, values):
+        count = len(values)
+        is_int = [isinstance(v, int) for v in values]
+        mask = sum([1 << k for k in range(0, count) if is_int[k]])
+        fmt = '<%ds%ds' % (count, mask_len(count)) + ''.join(['q' if i else 'd' for i in is_int])
+        layout = (struct.Struct(fmt), mask.to_bytes(mask_len(count), 'little'))
+        self.layouts[sources] = layout
+        return layout
+
+    def end_op(self):
+        values = self.values
+        self.values = None
+        sources = bytes(self.sources)
+        layout = self.layouts.get(sources)
+        if layout is None:
+            layout = self.layout(sources, values)
+        (packer, mask) = layout
+        self.f.write(struct.pack(record_format, self.t, self.opcode, len(values)) +
+                     packer.pack(sources, mask, *values))
+        self.ops += 1
+
+    def close(self):
+        self.f.close()
+
+
+class trace_replayer(tracer):
+
+    replaying = True
+
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.f = open(pathname, 'rb')
+        header = self.f.read(header_len)
+        if len(header) < header_len or struct.unpack(header_format, header) != (trace_magic, trace_version):
+            raise Exception('%s is not an fs-drift trace, version %d' % (pathname, trace_version))
+        self.layouts = {}
+        self.values = {}
+        self.ops = 0
+        self.misses = 0
+
+    # the layout is the struct for the values, and for each source the
+    # positions of its values in reverse order, so that they can be popped
+
+    def layout(self, key, count):
+        sources = key[0:count]
+        mask = int.from_bytes(key[count:], 'little')
+        unpacker = struct.Struct('<' + ''.join(['q' if (mask >> k) & 1 else 'd' for k in range(0, count)]))
+        positions = {}
+        for k in range(count - 1, -1, -1):
+            positions.setdefault(sources[k], []).append(k)
+        layout = (unpacker, list(positions.items()))
+        self.layouts[key] = layout
+        return layout
+
+    # returns (start time, opcode) of the next operation, or None at the
+    # end of the trace.  a record cut short, as by a recording run that
+    # was killed, ends the trace
+
+    def next_op(self):
+        header = self.f.read(record_len)
+        if len(header) < record_len:
+            return None
+        (t, opcode, count) = struct.unpack(record_format, header)
+        key_len = count + mask_len(count)
+        body = self.f.read(key_len + 8 * count)
+        if len(body) < key_len + 8 * count:
+            return None
+        key = body[0:key_len]
+        layout = self.layouts.get(key)
+        if layout is None:
+            layout = self.layout(key, count)
+        (unpacker, positions) = layout
+        values = unpacker.unpack_from(body, key_len)
+        self.values = dict([(source, [values[k] for k in where]) for (source, where) in positions])
+        self.stream_state = None
+        self.ops += 1
+        return (t, opcode)
+
+    def value(self, source, gen, *args):
+        recorded = self.values.get(source)
+        if recorded:
+            return recorded.pop()
+        self.misses += 1
+        return gen(*args)
+
+    def close(self):
+        self.f.close()
@@ -36,8 +36,25 @@ def usage(msg):
     print('-+v|--mean-velocity')
     print('-+d|--gaussian-stddev')
     print('-+c|--create_stddevs-ahead')
+    print('-+z|--zipf-theta')
+    print('-+h|--hot-set-pct')
+    print('-+H|--hot-ops-pct')
     print('-c|--compression_ratio')
     print('-p|--pause_file')
+    print('-P|--workers')
+    print('-+p|--precreate-dirs')
+    print('-+q|--queue-depth')
+    print('-+C|--controller')
+    print('-+R|--target-rate')
+    print('-+a|--arrival')
+    print('-+f|--prefill')
+    print('-+O|--direct')
+    print('-+e|--io-engine')
+    print('-+j|--stats-stream')
+    print('-+J|--stats-format')
+    print('-+t|--record-trace')
+    print('-+y|--replay-trace')
+    print('-+Y|--replay-timing')
     sys.exit(NOTOK)
 
 # command line parameter variables here
@@ -70,9 +87,27 @@ mean_index_velocity = 0.0  # default is a fixed mean for the distribution
 gaussian_stddev = 1000.0  # just a guess, means most of accesses within 1000 files?
 # just a guess, most files will be created before they are read
 create_stddevs_ahead = 3.0
+# parameters for zipf, latest and hotspot filename distributions
+zipf_theta = 0.99
+hot_set_pct = 20.0
+hot_ops_pct = 80.0
 drift_time = -1
 pause_file = '/var/tmp/pause'
 compression_ratio = 0.0
+workers = 1
+precreate_dirs = 0
+queue_depth = 1
+controller = None
+target_rate = 0.0
+arrival = 'fixed'
+prefill = 0.0
+direct = False
+io_engine = 'syscall'
+stats_stream = None
+stats_format = 'json'
+record_trace = None
+replay_trace = None
+replay_timing = 'fast'
 
 
 def parseopts():
@@ -81,7 +116,10 @@ def parseopts():
     global fsync_probability_pct, fdatasync_probability_pct, workload_table_filename
     global stats_report_interval, levels, dirs_per_level
     global rand_distr_type, rand_distr_type_str, mean_index_velocity, gaussian_stddev, create_stddevs_ahead
-    global compression_ratio
+    global zipf_theta, hot_set_pct, hot_ops_pct
+    global compression_ratio, workers, precreate_dirs, queue_depth, controller, pause_file
+    global target_rate, arrival, prefill, direct, io_engine
+    global stats_stream, stats_format, record_trace, replay_trace, replay_timing
     if len(sys.argv) % 2 != 1:
         usage('all options must have a value')
     try:
@@ -140,8 +178,14 @@ def parseopts():
                     rand_distr_type = file_access_dist.UNIFORM
                 elif v == 'gaussian':
                     rand_distr_type = file_access_dist.GAUSSIAN
+                elif v == 'zipf':
+                    rand_distr_type = file_access_dist.ZIPF
+                elif v == 'hotspot':
+                    rand_distr_type = file_access_dist.HOTSPOT
+                elif v == 'latest':
+                    rand_distr_type = file_access_dist.LATEST
                 else:
-                    usage('random distribution must be "uniform" or "gaussian"')
+                    usage('random distribution must be "uniform", "gaussian", "zipf", "hotspot" or "latest"')
                 rand_distr_type_str = v
             elif nm == '--mean-velocity' or nm == '-+v':
                 mean_index_velocity = float(val)
@@ -149,14 +193,73 @@ def parseopts():
                 gaussian_stddev = float(val)
             elif nm == '--create_stddevs-ahead' or nm == '-+c':
                 create_stddevs_ahead = float(val)
+            elif nm == '--zipf-theta' or nm == '-+z':
+                zipf_theta = float(val)
+                if zipf_theta <= 0.0 or zipf_theta >= 1.0:
+                    usage('zipf theta must be greater than 0 and less than 1')
+            elif nm == '--hot-set-pct' or nm == '-+h':
+                hot_set_pct = float(val)
+            elif nm == '--hot-ops-pct' or nm == '-+H':
+                hot_ops_pct = float(val)
             elif nm == '--compression-ratio' or nm == '-c':
-                compression_ratio = float(val)                
+                compression_ratio = float(val)
+                if compression_ratio != 0.0 and compression_ratio < 1.0:
+                    usage('compression ratio must be 0 (incompressible) or at least 1.0')
             elif nm == '--pause_file' or nm == '-p':
                 pause_file = val
+            elif nm == '--workers' or nm == '-P':
+                workers = int(val)
+                if workers < 1:
+                    usage('worker count must be at least 1')
+            elif nm == '--precreate-dirs' or nm == '-+p':
+                precreate_dirs = int(val)
+            elif nm == '--queue-depth' or nm == '-+q':
+                queue_depth = int(val)
+                if queue_depth < 1:
+                    usage('queue depth must be at least 1')
+            elif nm == '--controller' or nm == '-+C':
+                if ':' not in val:
+                    usage('controller must be specified as host:port')
+                controller = val
+            elif nm == '--target-rate' or nm == '-+R':
+                target_rate = float(val)
+            elif nm == '--arrival' or nm == '-+a':
+                arrival = val.lower()
+                if arrival != 'fixed' and arrival != 'poisson':
+                    usage('arrival schedule must be "fixed" or "poisson"')
+            elif nm == '--prefill' or nm == '-+f':
+                prefill = float(val)
+                if prefill < 0.0 or prefill > 1.0:
+                    usage('prefill must be a fraction between 0.0 and 1.0')
+            elif nm == '--direct' or nm == '-+O':
+                v = val.lower()
+                direct = (v == 'true' or v == 'yes' or v == 'on')
+            elif nm == '--io-engine' or nm == '-+e':
+                io_engine = val.lower()
+                if io_engine != 'syscall' and io_engine != 'mmap':
+                    usage('I/O engine must be "syscall" or "mmap"')
+            elif nm == '--stats-stream' or nm == '-+j':
+                stats_stream = val
+            elif nm == '--stats-format' or nm == '-+J':
+                stats_format = val.lower()
+                if stats_format != 'json' and stats_format != 'csv':
+                    usage('stats format must be "json" or "csv"')
+            elif nm == '--record-trace' or nm == '-+t':
+                record_trace = val
+            elif nm == '--replay-trace' or nm == '-+y':
+                replay_trace = val
+            elif nm == '--replay-timing' or nm == '-+Y':
+                replay_timing = val.lower()
+                if replay_timing != 'fast' and replay_timing != 'original':
+                    usage('replay timing must be "fast" or "original"')
             else:
                 usage('syntax error for option %s value %s' % (nm, val))
     except Exception as e:
         usage(str(e))
+    if direct and io_engine == 'mmap':
+        usage('--direct can not be used with the mmap I/O engine')
+    if record_trace and replay_trace:
+        usage('--record-trace and --replay-trace can not be used together')
     print('')
     print((
         '%20s = top directory\n'
@@ -180,15 +283,38 @@ def parseopts():
         '%11s%9.1f = create stddevs ahead\n'
         '%20s = save response times\n'
         '%20s = save bandwidth\n'
+        '%20s = direct I/O\n'
+        '%20s = I/O engine\n'
         '%11s%9.1f = compression ratio\n'
+        '%11s%9d = worker processes\n'
+        '%11s%9d = directory precreate threads\n'
+        '%11s%9d = queue depth per worker\n'
         % (top_directory, str(starting_gun_file), '', opcount, '', duration, '', max_files, '', max_file_size_kb,
            '', max_record_size_kb, '', fix_record_size_kb, '', max_random_reads, '', max_random_writes, '', singleIO,
            '', fdatasync_probability_pct, '', fsync_probability_pct,
            '', levels, '', dirs_per_level,
            rand_distr_type_str, '', mean_index_velocity, '', gaussian_stddev, '', create_stddevs_ahead,
-           str(rsptimes), str(bw), '', compression_ratio)))
+           str(rsptimes), str(bw), str(direct), io_engine, '', compression_ratio, '', workers,
+           '', precreate_dirs, '', queue_depth)))
     if workload_table_filename != None:
         print('%20s = workload table filename' % workload_table_filename)
+    if controller != None:
+        print('%20s = controller' % controller)
+    if stats_stream != None:
+        print('%20s = %s stats stream' % (stats_stream, stats_format))
+    if record_trace != None:
+        print('%20s = record trace prefix' % record_trace)
+    if replay_trace != None:
+        print('%20s = replay trace prefix, %s timing' % (replay_trace, replay_timing))
+    if target_rate > 0:
+        print('%11s%9.1f = target ops/s, %s arrivals' % ('', target_rate, arrival))
+    if prefill > 0:
+        print('%11s%9.3f = prefill fraction' % ('', prefill))
+    if rand_distr_type == file_access_dist.ZIPF or rand_distr_type == file_access_dist.LATEST:
+        print('%11s%9.3f = zipf theta' % ('', zipf_theta))
+    if rand_distr_type == file_access_dist.HOTSPOT:
+        print('%11s%9.1f = percent of operations to hot set' % ('', hot_ops_pct))
+        print('%11s%9.1f = percent of files in hot set' % ('', hot_set_pct))
     if stats_report_interval > 0:
         print('%11s%9d = statistics report intervalpercentage' %
               ('', stats_report_interval))
@@ -1,40 +1,45 @@
-# random_buffer.py - generate a random but printable text string
+# random_buffer.py - generate a random but printable text string,
+# or data that compresses by a requested ratio
 
 import string
-import array
-import shlex
+import numpy
 import opts
-from common import fsdrift_directory
-from subprocess import Popen, PIPE, call
 
+# compressible data is built from blocks of this size, each starting with
+# random bytes (1/ratio of the block) that are then repeated to fill the
+# block.  LZ-style compressors reduce the repeats to back-references, so the
+# buffer compresses by about the requested ratio, and since every block has
+# its own random bytes the buffer does not dedupe into a few blocks.  the
+# buffer is only as large as the write ring in fsop, though, so data written
+# by a long run does repeat (see the comment on buf_ring there).
 
-def get_lz_data(params):
-    args = shlex.split(params)
-    proc = Popen([fsdrift_directory+'/lzdatagen/lzdgen'] +
-                 args, stdout=PIPE, stderr=PIPE)
-    out, error = proc.communicate()
+COMPRESSIBLE_BLOCK_SIZE = 4096
+
+
+def gen_compressible_buffer(size_bytes, ratio):
+    literal_sz = max(1, int(COMPRESSIBLE_BLOCK_SIZE / ratio))
+    block_count = (size_bytes // COMPRESSIBLE_BLOCK_SIZE) + 1
+    literals = numpy.frombuffer(numpy.random.bytes(block_count * literal_sz),
+                                dtype=numpy.uint8).reshape(block_count, literal_sz)
+    repeats = (COMPRESSIBLE_BLOCK_SIZE // literal_sz) + 1
+    blocks = numpy.tile(literals, (1, repeats))[:, 0:COMPRESSIBLE_BLOCK_SIZE]
+    return bytearray(blocks.tobytes()[0:size_bytes])
 
-    if error:
-        print(error)
-    return out
 
 def gen_buffer( size_bytes ):
     if opts.compression_ratio == 0.0:
-       b = array.array('B')
-       for k in range(0, size_bytes):
-               index = k % len(string.printable)
-               printable_char = string.printable[index]
-               b.append(ord(printable_char))
-       return b
+       pattern = string.printable.encode()
+       repeats = (size_bytes // len(pattern)) + 1
+       return bytearray(pattern * repeats)[0:size_bytes]
     else:
-        if size_bytes == 0:
-            return ''
-        params = '-r ' + str(opts.compression_ratio) + ' -s ' + str(size_bytes) + ' -'
-        data = get_lz_data(params)
-        return data
-        
+        return gen_compressible_buffer(size_bytes, opts.compression_ratio)
+
 
 
 if __name__ == '__main__':
+    import zlib
     print(gen_buffer(100))
-
+    for ratio in (1.0, 2.0, 4.0, 10.0):
+        b = bytes(gen_compressible_buffer(1 << 20, ratio))
+        print('requested ratio %5.1f zlib ratio %5.2f' % (
+            ratio, float(len(b)) / len(zlib.compress(b))))
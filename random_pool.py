@@ -0,0 +1,91 @@
+# random_pool.py - hand out random values that are generated in vectorized blocks
+#
+# drawing one value at a time from random or numpy.random costs one or more
+# python function calls per value, which is a measurable part of the time
+# spent on a small-file operation.  a pool generates BLOCK_SIZE values with
+# one numpy call and then hands them out from a cursor.
+
+import threading
+
+BLOCK_SIZE = 1 << 16
+
+# every pool that has been created, so they can all be emptied after the
+# random generators are reseeded (for example in a newly forked worker)
+
+all_pools = []
+
+# when an operation trace is being recorded or replayed (see optrace.py),
+# tracing is set and each operation thread has a tracer in trace_local.
+# every random value an operation uses then goes through traced(), which
+# records it, or hands out the recorded value instead during replay.
+# values are tagged with the number of their source (a pool, or a function
+# passed to trace_source()), so a replayed operation that takes a different
+# path still gets values of the right kind.  sources are numbered in the
+# order they are created at import time, which is the same in every run
+
+tracing = False
+trace_local = threading.local()
+trace_sources = []
+
+
+def trace_source(source):
+    if source not in trace_sources:
+        trace_sources.append(source)
+    return trace_sources.index(source)
+
+
+def current_tracer():
+    if tracing:
+        return getattr(trace_local, 'tracer', None)
+    return None
+
+
+def traced(source, gen, *args):
+    tracer = current_tracer()
+    if tracer is not None:
+        return tracer.value(source, gen, *args)
+    return gen(*args)
+
+
+# a pool is thread-local: __init__ runs again in every thread that uses it,
+# so each thread (see --queue-depth) hands out values from its own block.
+# values from a pool with traced=False are not traced, because the caller
+# traces something computed from them instead
+
+class random_pool(threading.local):
+
+    # gen_block(n) must return a numpy array of n random values
+
+    def __init__(self, gen_block, block_size=BLOCK_SIZE, traced=True):
+        self.gen_block = gen_block
+        self.block_size = block_size
+        self.traced = traced
+        self.source = trace_source(self)
+        self.generation = 0  # for use by the owner of the pool
+        self.reset()
+        if self not in all_pools:
+            all_pools.append(self)
+
+    def reset(self):
+        self.block = []
+        self.cursor = 0
+
+    def next(self):
+        if tracing and self.traced:
+            tracer = current_tracer()
+            if tracer is not None:
+                return tracer.value(self.source, self.next_untraced)
+        return self.next_untraced()
+
+    def next_untraced(self):
+        if self.cursor >= len(self.block):
+            self.block = self.gen_block(self.block_size).tolist()
+            self.cursor = 0
+        v = self.block[self.cursor]
+        self.cursor += 1
+        return v
+
+
+def reset_all():
+    for p in all_pools:
+        p.reset()
@@ -0,0 +1,165 @@
+# stats.py - snapshots of fs-drift counters, and a stream of them in a
+# machine-readable format
+#
+# a snapshot is a copy of a set of named counters, as published by a worker
+# or summed across workers or hosts.  the counters are cumulative, so
+# subtracting the snapshot taken at the start of an interval from the one
+# taken at its end gives the counts for that interval, which can then be
+# turned into rates.  values are kept in one numpy array, so snapshots of
+# hundreds of workers are cheap to add up.
+
+import json
+import csv
+import numpy
+from common import BYTES_PER_MB
+from histogram import report_percentiles
+
+# counters that hold a current value instead of a count, so they are not
+# added up or subtracted.  the most advanced value is the interesting one.
+# publish_time is when a worker last published its counters
+
+level_names = ('last_center', 'publish_time')
+
+# byte counters that go into the read and write MB/s rates
+
+read_byte_names = ('read_bytes', 'randread_bytes')
+write_byte_names = ('write_bytes', 'randwrite_bytes', 'copy_bytes', 'clone_bytes')
+
+
+class counter_snapshot:
+
+    __slots__ = ('names', 'index', 'levels', 'values')
+
+    def __init__(self, names, values=None):
+        self.names = tuple(names)
+        self.index = dict([(name, k) for (k, name) in enumerate(self.names)])
+        self.levels = numpy.array([name in level_names for name in self.names], dtype=bool)
+        if values is None:
+            self.values = numpy.zeros(len(self.names))
+        else:
+            self.values = numpy.array(values, dtype=numpy.float64)
+
+    @staticmethod
+    def from_dict(d):
+        return counter_snapshot(list(d.keys()), list(d.values()))
+
+    def as_dict(self):
+        return dict(zip(self.names, self.values.tolist()))
+
+    def __getitem__(self, name):
+        return self.values[self.index[name]]
+
+    def get(self, name, default=0):
+        k = self.index.get(name)
+        if k is None:
+            return default
+        return self.values[k]
+
+    # a copy sharing the names, which is not changed by changes to this one
+
+    def snapshot(self):
+        s = counter_snapshot.__new__(counter_snapshot)
+        s.names = self.names
+        s.index = self.index
+        s.levels = self.levels
+        s.values = self.values.copy()
+        return s
+
+    # counts since an earlier snapshot of the same counters
+
+    def delta(self, earlier):
+        d = self.snapshot()
+        d.values -= numpy.where(self.levels, 0.0, earlier.values)
+        return d
+
+    # operations and MB per second, for a snapshot or delta covering
+    # the given number of seconds
+
+    def rates(self, seconds):
+        if seconds <= 0:
+            return {'ops': 0.0, 'read_mb': 0.0, 'write_mb': 0.0}
+        return {'ops': self.get('events') / seconds,
+                'read_mb': sum([self.get(n) for n in read_byte_names]) / BYTES_PER_MB / seconds,
+                'write_mb': sum([self.get(n) for n in write_byte_names]) / BYTES_PER_MB / seconds}
+
+    # add up snapshots of the same counters, for example from every worker
+
+    @staticmethod
+    def merge(snapshots):
+        total = snapshots[0].snapshot()
+        for s in snapshots[1:]:
+            total.values = numpy.where(total.levels,
+                                       numpy.maximum(total.values, s.values),
+                                       total.values + s.values)
+        return total
+
+# workers and agents publish their counters on their own schedules, so
+# counts summed across them at some moment cover a different window for
+# each one.  the rates for the set are the sum of each one's rates, given
+# as (delta, seconds) with seconds the time between its own two snapshots
+
+
+def summed_rates(deltas):
+    total = {'ops': 0.0, 'read_mb': 0.0, 'write_mb': 0.0}
+    for (d, seconds) in deltas:
+        r = d.rates(seconds)
+        for k in total.keys():
+            total[k] += r[k]
+    return total
+
+
+# one record per report interval, as a JSON object per line or a CSV row,
+# written to a file or named pipe for dashboards to read instead of parsing
+# the text report.  a record has the time, the counters and rates for the
+# interval, and latency percentiles (in milliseconds) of the operations done
+# in the interval.  CSV has a fixed column for every counter and every
+# percentile of every histogram, left empty when no such operation was done
+
+percentile_keys = ['p%g' % p for p in report_percentiles]
+latency_keys = ['count'] + percentile_keys + ['max']
+
+
+def latency_summary(h):
+    return dict(zip(latency_keys, [h.count()] +
+                    [h.percentile(p) * 1000.0 for p in report_percentiles] + [h.max() * 1000.0]))
+
+
+class stats_stream:
+
+    def __init__(self, filename, fmt, counter_names, hist_names):
+        self.fmt = fmt
+        self.counter_names = counter_names
+        self.hist_names = hist_names
+        self.f = open(filename, 'w')
+        if fmt == 'csv':
+            self.csv_writer = csv.writer(self.f)
+            self.csv_writer.writerow(
+                ['time', 'elapsed', 'interval', 'ops_per_sec', 'read_mb_per_sec', 'write_mb_per_sec'] +
+                list(counter_names) +
+                ['%s.%s' % (name, k) for name in hist_names for k in latency_keys])
+
+    # d is a counter_snapshot delta, r its rates and histograms a list
+    # of (name, latency_histogram) for the interval
+
+    def write(self, now, elapsed, interval, d, r, histograms):
+        latency = dict([(name, latency_summary(h)) for (name, h) in histograms if h.count() > 0])
+        if self.fmt == 'csv':
+            row = [now, elapsed, interval, r['ops'], r['read_mb'], r['write_mb']]
+            row.extend([d.get(name) for name in self.counter_names])
+            for name in self.hist_names:
+                summary = latency.get(name)
+                if summary is None:
+                    row.extend([''] * len(latency_keys))
+                else:
+                    row.extend([summary[k] for k in latency_keys])
+            self.csv_writer.writerow(row)
+        else:
+            record = {'time': now, 'elapsed': elapsed, 'interval': interval,
+                      'ops_per_sec': r['ops'], 'read_mb_per_sec': r['read_mb'],
+                      'write_mb_per_sec': r['write_mb'],
+                      'counters': d.as_dict(), 'latency_ms': latency}
+            self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
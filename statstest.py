@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+# statstest.py - check merging and subtracting counter snapshots and latency
+# histograms, which the controller and the interval reports depend on.
+# run it with no parameters, it exits with a non-zero status if a check fails
+
+import sys
+from common import OK
+from stats import counter_snapshot, summed_rates
+from histogram import latency_histogram, bucket_index
+
+names = ('events', 'read_bytes', 'write_bytes', 'last_center', 'publish_time')
+
+
+def check_counter_snapshot():
+    a = counter_snapshot(names, [10, 1 << 20, 0, 5, 100.0])
+    b = counter_snapshot(names, [20, 0, 2 << 20, 7, 99.0])
+
+    # counts add up, levels take the most advanced value
+    total = counter_snapshot.merge([a, b])
+    assert total.as_dict() == {'events': 30, 'read_bytes': 1 << 20, 'write_bytes': 2 << 20,
+                               'last_center': 7, 'publish_time': 100.0}
+    assert a['events'] == 10 and b['events'] == 20
+
+    # counts are subtracted, levels are kept
+    later = counter_snapshot(names, [25, 3 << 20, 0, 9, 104.0])
+    d = later.delta(a)
+    assert d.as_dict() == {'events': 15, 'read_bytes': 2 << 20, 'write_bytes': 0,
+                           'last_center': 9, 'publish_time': 104.0}
+    assert later['events'] == 25
+
+    # a snapshot doesn't change with the counters it was taken from
+    s = a.snapshot()
+    a.values[0] += 1
+    assert s['events'] == 10
+
+    r = d.rates(5.0)
+    assert r == {'ops': 3.0, 'read_mb': 0.4, 'write_mb': 0.0}
+    assert d.rates(0) == {'ops': 0.0, 'read_mb': 0.0, 'write_mb': 0.0}
+
+    # each delta is divided by its own interval before rates are summed
+    r = summed_rates([(d, 5.0), (counter_snapshot(names, [10, 0, 1 << 20, 0, 0]), 2.0)])
+    assert r == {'ops': 8.0, 'read_mb': 0.4, 'write_mb': 0.5}
+
+    assert counter_snapshot.from_dict(total.as_dict()).as_dict() == total.as_dict()
+    assert total.get('no-such-counter') == 0
+
+
+def check_latency_histogram():
+    a = latency_histogram()
+    for usec in (10, 20, 30):
+        a.record(usec / 1000000.0)
+    b = latency_histogram()
+    for usec in (1000, 2000):
+        b.record(usec / 1000000.0)
+
+    # counts add up per bucket, the maximum is the larger one
+    total = latency_histogram(a.values)
+    total.merge(b)
+    assert total.count() == 5
+    assert total.max() == 0.002
+    assert total.values[bucket_index(10)] == 1
+    assert total.values[bucket_index(1000)] == 1
+    assert a.count() == 3 and b.count() == 2
+
+    # samples since an earlier copy, with their maximum estimated from the
+    # highest bucket but no more than the maximum so far
+    earlier = latency_histogram(a.values)
+    a.record(0.0005)
+    a.record(0.000015)
+    d = a.delta(earlier)
+    assert d.count() == 2
+    assert d.values[bucket_index(500)] == 1
+    assert d.values[bucket_index(15)] == 1
+    assert d.values[bucket_index(10)] == 0
+    assert 0.0005 <= d.max() <= a.max()
+    assert a.count() == 5 and earlier.count() == 3
+
+    assert a.delta(a).count() == 0
+    assert a.delta(a).max() == 0
+    assert latency_histogram().percentile(50.0) == 0.0
+    assert total.percentile(100.0) == 0.002
+
+
+if __name__ == '__main__':
+    check_counter_snapshot()
+    check_latency_histogram()
+    print('stats checks passed')
+    sys.exit(OK)